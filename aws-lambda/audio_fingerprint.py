@@ -0,0 +1,271 @@
+import io
+import json
+import boto3
+import os
+import random
+import subprocess
+import time
+import numpy as np
+from botocore.exceptions import ClientError
+from datetime import datetime
+
+from extract_transcript_lambda import FFMPEG_PATH
+
+# AWS clients
+s3 = boto3.client('s3')
+
+# 指紋化に使う音声（先頭から最大この秒数だけデコードしてメモリを一定に保つ）
+FINGERPRINT_SAMPLE_RATE = 8000
+FINGERPRINT_MAX_SECONDS = int(os.environ.get('FINGERPRINT_MAX_SECONDS', '600'))
+
+# スペクトログラム・ピーク検出のパラメータ
+FFT_SIZE = 1024
+HOP_SIZE = 512
+PEAK_FREQ_NEIGHBORHOOD = 15
+PEAK_TIME_NEIGHBORHOOD = 7
+PEAK_PERCENTILE = 98
+PEAK_FAN_OUT = 5
+PEAK_MAX_DT = 63
+
+# 1動画あたりに保存するハッシュ数の上限（インデックスのメモリを有界にする）
+MAX_HASHES_PER_VIDEO = 1000
+
+# 重複と判定する条件（時間差が揃った一致ハッシュ数）
+MIN_ALIGNED_MATCHES = int(os.environ.get('FINGERPRINT_MIN_MATCHES', '20'))
+MIN_MATCH_RATIO = float(os.environ.get('FINGERPRINT_MIN_RATIO', '0.1'))
+# 指紋は先頭部分しか見ないため、全体の長さも一致した場合のみ重複とみなす（編集版を取りこぼさない）
+DURATION_TOLERANCE_SECONDS = float(os.environ.get('FINGERPRINT_DURATION_TOLERANCE', '2'))
+
+# インデックスと登録動画一覧は1つのオブジェクトに保存し、ETagによる条件付き書き込みで更新する
+INDEX_KEY = 'fingerprints/index.npz'
+# 同時登録で条件付き書き込みが競合した場合の再試行回数
+REGISTER_MAX_ATTEMPTS = 8
+
+# ウォームスタート時はETagが同じならインデックスを再ダウンロードしない
+_index_cache = {'etag': None, 'index': None}
+
+def decode_pcm(audio_path):
+    """FFmpegで音声を8kHzモノラルのfloat32 PCMにデコード"""
+    cmd = [
+        FFMPEG_PATH, '-v', 'quiet', '-i', audio_path,
+        '-t', str(FINGERPRINT_MAX_SECONDS),
+        '-ac', '1', '-ar', str(FINGERPRINT_SAMPLE_RATE),
+        '-f', 's16le', '-'
+    ]
+    result = subprocess.run(cmd, capture_output=True, timeout=300)
+    if result.returncode != 0:
+        raise Exception("指紋用の音声デコードに失敗しました")
+    return np.frombuffer(result.stdout, dtype=np.int16).astype(np.float32) / 32768.0
+
+def spectrogram(samples):
+    """窓付きSTFTの対数振幅（frames x bins）"""
+    if len(samples) < FFT_SIZE:
+        return np.zeros((0, FFT_SIZE // 2), dtype=np.float32)
+    frames = np.lib.stride_tricks.sliding_window_view(samples, FFT_SIZE)[::HOP_SIZE]
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(FFT_SIZE).astype(np.float32), axis=1))
+    # ナイキスト成分を除いて周波数ビンを9bitに収める
+    return np.log1p(spectrum[:, :FFT_SIZE // 2]).astype(np.float32)
+
+def sliding_max(values, size, axis):
+    """指定軸方向の移動最大値（端は-infで埋める）"""
+    half = size // 2
+    pad = [(0, 0), (0, 0)]
+    pad[axis] = (half, half)
+    padded = np.pad(values, pad, constant_values=-np.inf)
+    return np.lib.stride_tricks.sliding_window_view(padded, size, axis=axis).max(axis=-1)
+
+def find_peaks(spec):
+    """近傍で最大かつ上位パーセンタイルに入る点をスペクトルピークとして抽出
+    
+    閾値を分位点で決めるため、音量差や再エンコードのノイズの影響を受けにくい。
+    """
+    if spec.size == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    local_max = sliding_max(sliding_max(spec, PEAK_TIME_NEIGHBORHOOD, 0), PEAK_FREQ_NEIGHBORHOOD, 1)
+    mask = (spec == local_max) & (spec > np.percentile(spec, PEAK_PERCENTILE))
+    times, freqs = np.nonzero(mask)
+    return times, freqs
+
+def peak_hashes(times, freqs):
+    """ピークの組（f1, f2, Δt）を32bitハッシュに変換
+    
+    Returns:
+        (hashes uint32, アンカー時刻 uint32)
+    """
+    order = np.lexsort((freqs, times))
+    times, freqs = times[order], freqs[order]
+    
+    hashes, anchors = [], []
+    for k in range(1, PEAK_FAN_OUT + 1):
+        dt = times[k:] - times[:-k]
+        valid = (dt > 0) & (dt <= PEAK_MAX_DT)
+        f1 = freqs[:-k][valid]
+        f2 = freqs[k:][valid]
+        hashes.append((f1 << 15) | (f2 << 6) | dt[valid])
+        anchors.append(times[:-k][valid])
+    
+    if not hashes:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.uint32)
+    return np.concatenate(hashes).astype(np.uint32), np.concatenate(anchors).astype(np.uint32)
+
+def select_hashes(hashes, anchors):
+    """ハッシュ値の混合値が小さい順に上限数だけ残す
+    
+    値に基づく選択なので、同じ音声の再エンコード版でも同じハッシュが残りやすい。
+    """
+    hashes, first = np.unique(hashes, return_index=True)
+    anchors = anchors[first]
+    if len(hashes) <= MAX_HASHES_PER_VIDEO:
+        return hashes, anchors
+    mixed = (hashes.astype(np.uint64) * np.uint64(2654435761)) & np.uint64(0xFFFFFFFF)
+    keep = np.argpartition(mixed, MAX_HASHES_PER_VIDEO)[:MAX_HASHES_PER_VIDEO]
+    return hashes[keep], anchors[keep]
+
+def fingerprint_samples(samples):
+    """PCMサンプルから指紋（ハッシュ・時刻の配列）を計算"""
+    times, freqs = find_peaks(spectrogram(samples))
+    hashes, anchors = peak_hashes(times.astype(np.int64), freqs.astype(np.int64))
+    hashes, anchors = select_hashes(hashes, anchors)
+    return {'hashes': hashes, 'times': anchors, 'duration': len(samples) / FINGERPRINT_SAMPLE_RATE}
+
+def fingerprint_audio(audio_path):
+    """音声ファイルの指紋を計算"""
+    fingerprint = fingerprint_samples(decode_pcm(audio_path))
+    print(f"🔑 音声指紋: {len(fingerprint['hashes'])}ハッシュ ({fingerprint['duration']:.0f}秒分)")
+    return fingerprint
+
+def _error_code(error):
+    return error.response.get('Error', {}).get('Code')
+
+def empty_index():
+    return {
+        'hashes': np.zeros(0, dtype=np.uint32),
+        'videos': np.zeros(0, dtype=np.uint32),
+        'times': np.zeros(0, dtype=np.uint32),
+        'registry': [],
+        'etag': None
+    }
+
+def load_index(bucket):
+    """S3から転置インデックス（ハッシュ昇順）と登録動画一覧を取得
+    
+    インデックスが存在しない場合のみ空のインデックスを返し、
+    権限エラーやスロットリングなどはそのまま送出する（空とみなして上書きしないため）。
+    """
+    try:
+        head = s3.head_object(Bucket=bucket, Key=INDEX_KEY)
+    except ClientError as e:
+        if _error_code(e) in ('404', 'NoSuchKey', 'NotFound'):
+            return empty_index()
+        raise
+    
+    if _index_cache['etag'] != head['ETag']:
+        response = s3.get_object(Bucket=bucket, Key=INDEX_KEY)
+        data = np.load(io.BytesIO(response['Body'].read()))
+        _index_cache['index'] = {
+            'hashes': data['hashes'],
+            'videos': data['videos'],
+            'times': data['times'],
+            'registry': json.loads(str(data['registry'])),
+            'etag': response['ETag']
+        }
+        _index_cache['etag'] = response['ETag']
+    
+    return _index_cache['index']
+
+def match_fingerprint(index, fingerprint):
+    """時間差が揃った一致ハッシュ数が最大の登録動画を返す
+    
+    Returns:
+        (登録動画の番号 または None, 一致数)
+    """
+    if len(index['hashes']) == 0 or len(fingerprint['hashes']) == 0:
+        return None, 0
+    
+    lo = np.searchsorted(index['hashes'], fingerprint['hashes'], side='left')
+    hi = np.searchsorted(index['hashes'], fingerprint['hashes'], side='right')
+    counts = hi - lo
+    if counts.sum() == 0:
+        return None, 0
+    
+    # 一致した全エントリの位置を展開
+    query_pos = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    entry = lo[query_pos] + offsets
+    
+    videos = index['videos'][entry].astype(np.int64)
+    deltas = index['times'][entry].astype(np.int64) - fingerprint['times'][query_pos].astype(np.int64)
+    
+    # (動画, 時間差) ごとに集計し、最も揃っている動画を選ぶ
+    keys = videos * (1 << 32) + (deltas + (1 << 31))
+    unique_keys, key_counts = np.unique(keys, return_counts=True)
+    best = np.argmax(key_counts)
+    return int(unique_keys[best] >> 32), int(key_counts[best])
+
+def find_duplicate(bucket, fingerprint, duration):
+    """登録済みの動画から重複を検索（見つからなければNone）
+    
+    先頭のカットや一部の差し替えをした編集版は指紋が一致しても長さが変わるため、
+    登録時の長さとの差が DURATION_TOLERANCE_SECONDS 以内の場合のみ重複とする。
+    長さが記録されていない登録は照合対象にしない。
+    """
+    index = load_index(bucket)
+    video_idx, score = match_fingerprint(index, fingerprint)
+    required = max(MIN_ALIGNED_MATCHES, int(len(fingerprint['hashes']) * MIN_MATCH_RATIO))
+    
+    if video_idx is None or score < required:
+        print(f"🔍 重複なし (最大一致 {score} / 必要 {required})")
+        return None
+    
+    registered_duration = index['registry'][video_idx].get('duration')
+    if registered_duration is None or duration is None or abs(registered_duration - duration) > DURATION_TOLERANCE_SECONDS:
+        print(f"🔍 指紋は一致したが長さが異なるため別動画として処理 "
+              f"({index['registry'][video_idx]['video_key']}: {registered_duration}秒 / 今回 {duration}秒)")
+        return None
+    
+    duplicate = dict(index['registry'][video_idx], match_score=score)
+    print(f"♻️ 重複動画を検出: {duplicate['video_key']} (一致 {score})")
+    return duplicate
+
+def register_fingerprint(bucket, fingerprint, entry):
+    """指紋をインデックスに追加して保存
+    
+    読み込んだ時点のETagを条件に書き込み（新規作成時は If-None-Match）、
+    他の実行と競合した場合は読み直して再試行する。
+    """
+    for attempt in range(REGISTER_MAX_ATTEMPTS):
+        index = load_index(bucket)
+        registry = index['registry'] + [dict(entry, registered_at=datetime.now().isoformat())]
+        video_idx = len(registry) - 1
+        
+        hashes = np.concatenate([index['hashes'], fingerprint['hashes']])
+        videos = np.concatenate([index['videos'], np.full(len(fingerprint['hashes']), video_idx, dtype=np.uint32)])
+        times = np.concatenate([index['times'], fingerprint['times']])
+        order = np.argsort(hashes, kind='stable')
+        
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            hashes=hashes[order],
+            videos=videos[order],
+            times=times[order],
+            registry=np.array(json.dumps(registry, ensure_ascii=False))
+        )
+        
+        condition = {'IfMatch': index['etag']} if index['etag'] else {'IfNoneMatch': '*'}
+        try:
+            s3.put_object(Bucket=bucket, Key=INDEX_KEY, Body=buffer.getvalue(), **condition)
+        except ClientError as e:
+            if _error_code(e) not in ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409'):
+                raise
+            print(f"⚠️ 指紋インデックスの更新が競合、再試行します ({attempt + 1}/{REGISTER_MAX_ATTEMPTS})")
+            _index_cache['etag'] = None
+            # 同時に再試行が重ならないようジッター付きで待つ
+            time.sleep(random.uniform(0, 0.2 * (attempt + 1)))
+            continue
+        
+        _index_cache['etag'] = None
+        print(f"📚 指紋インデックスに登録: {entry['video_key']} (登録数 {len(registry)})")
+        return
+    
+    raise Exception("指紋インデックスの更新が競合し続けたため登録できませんでした")
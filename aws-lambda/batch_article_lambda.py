@@ -0,0 +1,395 @@
+import json
+import boto3
+import os
+import re
+import time
+import requests
+from datetime import datetime
+
+from generate_article_lambda import (
+    ARTICLE_MAX_TOKENS,
+    ARTICLE_MODEL,
+    ARTICLE_PROMPT_VERSION,
+    ARTICLE_TEMPERATURE,
+    article_cache_key,
+    build_article_messages,
+    load_cached_article,
+    parse_transcript_content,
+    save_article_outputs,
+    store_cached_article,
+    strip_code_fences,
+)
+from transcript_normalizer import NORMALIZATION_ENABLED, normalize_transcript
+
+# AWS clients
+s3 = boto3.client('s3')
+
+# OpenAI Batch API（ローカルスタブで試験する場合は OPENAI_API_BASE を差し替える）
+OPENAI_API_BASE = os.environ.get('OPENAI_API_BASE', 'https://api.openai.com/v1').rstrip('/')
+BATCH_COMPLETION_WINDOW = '24h'
+BATCH_MANIFEST_PREFIX = 'batches/'
+# Batch APIの入力ファイル1つあたりの上限（リクエスト数 50,000件 / 200MB）に余裕を持たせて分割する
+BATCH_MAX_REQUESTS = int(os.environ.get('BATCH_MAX_REQUESTS', '50000'))
+BATCH_MAX_FILE_BYTES = int(os.environ.get('BATCH_MAX_FILE_BYTES', str(190 * 1024 * 1024)))
+
+# 完了とみなすバッチステータス
+BATCH_FINAL_STATUSES = ['completed', 'failed', 'expired', 'cancelled']
+
+def lambda_handler(event, context):
+    """
+    Lambda関数2b: 過去動画の記事をOpenAI Batch APIで一括生成（バックフィル）
+    
+    Input:
+    - action=submit: transcript_keys または prefix（必須。記事が既にある動画はスキップ）
+    - action=poll: batch_id（EventBridge等で定期実行）
+    
+    Output: 完了したバッチの結果を articles/*.html とメタデータに展開
+    """
+    
+    try:
+        action = event.get('action', 'submit')
+        bucket = event.get('bucket') or os.environ.get('S3_BUCKET')
+        
+        if not bucket:
+            raise ValueError("bucket is required")
+        
+        print(f"🚀 バッチ記事生成開始 (action: {action})")
+        
+        if action == 'submit':
+            # 対象の指定漏れで transcripts/ 全体を投入しないよう、明示的な指定を必須にする
+            if event.get('transcript_keys'):
+                transcript_keys = event['transcript_keys']
+            elif event.get('prefix'):
+                transcript_keys = list_transcript_keys(bucket, event['prefix'])
+            else:
+                raise ValueError("transcript_keys or prefix is required")
+            result = submit_batch(
+                bucket, transcript_keys,
+                bypass_cache=event.get('bypass_cache', False),
+                skip_existing=event.get('skip_existing', True)
+            )
+        elif action == 'poll':
+            batch_id = event.get('batch_id')
+            if not batch_id:
+                raise ValueError("batch_id is required")
+            result = poll_batch(bucket, batch_id)
+        else:
+            raise ValueError(f"unknown action: {action}")
+        
+        return {
+            'statusCode': 200,
+            'body': json.dumps(result, ensure_ascii=False)
+        }
+    
+    except Exception as e:
+        print(f"❌ エラー: {str(e)}")
+        return {
+            'statusCode': 500,
+            'body': json.dumps({
+                'error': str(e)
+            }, ensure_ascii=False)
+        }
+
+def openai_headers():
+    """OpenAI REST API用の認証ヘッダー"""
+    return {'Authorization': f"Bearer {os.environ['OPENAI_API_KEY']}"}
+
+def list_transcript_keys(bucket, prefix):
+    """S3から文字起こしファイルのキー一覧を取得"""
+    keys = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('.txt'):
+                keys.append(obj['Key'])
+    return keys
+
+def has_existing_article(bucket, video_id, transcript_key):
+    """articles/article_[ID]_[DATE]_[TIME].html が既にあるか確認
+    
+    URLから動画IDを特定できない文字起こしはすべて 'unknown' になり互いに区別できないため、
+    IDでは照合せず、同じ文字起こしのタイムスタンプを引き継いだ記事（過去のバックフィル分）のみ確認する。
+    """
+    if video_id == 'unknown':
+        match = re.search(r'_(\d{8}_\d{6})\.txt$', transcript_key)
+        if not match:
+            return False
+        prefix = f"articles/article_unknown_{match.group(1)}.html"
+        pattern = re.compile(rf'^{re.escape(prefix)}$')
+    else:
+        prefix = f"articles/article_{video_id}_"
+        # 「abc」と「abc_x」のようにIDの前方が一致する別動画を除外する
+        pattern = re.compile(rf'^{re.escape(prefix)}\d{{8}}_\d{{6}}\.html$')
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        if any(pattern.match(obj['Key']) for obj in page.get('Contents', [])):
+            return True
+    return False
+
+def split_batch_lines(lines):
+    """JSONLの行を BATCH_MAX_REQUESTS 件・BATCH_MAX_FILE_BYTES 以下のファイル単位に分割
+    
+    Returns:
+        [(開始インデックス, 終了インデックス), ...]
+    """
+    ranges = []
+    start, size = 0, 0
+    for i, line in enumerate(lines):
+        line_bytes = len(line.encode('utf-8')) + 1
+        if line_bytes > BATCH_MAX_FILE_BYTES:
+            raise ValueError(f"バッチの1リクエストが入力ファイルの上限を超えています: {line_bytes} bytes")
+        if i > start and (i - start >= BATCH_MAX_REQUESTS or size + line_bytes > BATCH_MAX_FILE_BYTES):
+            ranges.append((start, i))
+            start, size = i, 0
+        size += line_bytes
+    if start < len(lines):
+        ranges.append((start, len(lines)))
+    return ranges
+
+def timestamp_from_transcript_key(transcript_key):
+    """transcript_[ID]_[DATE]_[TIME].txt からタイムスタンプを取得
+    
+    バッチでは同一秒に多数の記事を保存するため、文字起こし側のタイムスタンプを
+    引き継いでキーの衝突を防ぐ（再ポーリング時も同じキーに上書きされる）。
+    """
+    match = re.search(r'_(\d{8}_\d{6})\.txt$', transcript_key)
+    if match:
+        return match.group(1)
+    return datetime.now().strftime("%Y%m%d_%H%M%S")
+
+def load_transcript(bucket, transcript_key):
+    """文字起こしファイルを取得・解析"""
+    response = s3.get_object(Bucket=bucket, Key=transcript_key)
+    content = response['Body'].read().decode('utf-8')
+    return parse_transcript_content(content)
+
+def build_batch_request(custom_id, video_info, transcript_text):
+    """generate_article と同じプロンプトでBatch APIの1行分のリクエストを作成"""
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": ARTICLE_MODEL,
+            "messages": build_article_messages(video_info, transcript_text),
+            "max_tokens": ARTICLE_MAX_TOKENS,
+            "temperature": ARTICLE_TEMPERATURE
+        }
+    }
+
+def submit_batch(bucket, transcript_keys, bypass_cache=False, skip_existing=True):
+    """文字起こし群からJSONLを作成してBatch APIに投入し、マニフェストをS3に保存
+    
+    Batch APIの入力ファイル上限を超える場合は複数のバッチに分けて投入する。
+    skip_existing が有効なら、記事（articles/article_[ID]_*）が既にある動画は対象外にする。
+    """
+    print(f"📋 対象文字起こし: {len(transcript_keys)}件")
+    
+    lines = []
+    items = []
+    cached = []
+    existing = []
+    
+    for transcript_key in transcript_keys:
+        video_info, transcript_text, full_content = load_transcript(bucket, transcript_key)
+        if not video_info or not transcript_text:
+            print(f"⚠️ 解析に失敗したためスキップ: {transcript_key}")
+            continue
+        
+        if skip_existing and has_existing_article(bucket, video_info['id'], transcript_key):
+            print(f"⏭️ 記事が既にあるためスキップ: {transcript_key}")
+            existing.append(transcript_key)
+            continue
+        
+        # generate_article と同じく正規化した文字起こしをプロンプトに使う
+        normalization_info = None
+        if NORMALIZATION_ENABLED:
+            transcript_text, normalization_info = normalize_transcript(transcript_text)
+            normalization_info['raw_transcript_key'] = transcript_key
+        
+        cache_key = article_cache_key(video_info, transcript_text)
+        
+        # キャッシュ済みの記事はバッチに含めず即座に展開
+        cached_html = None if bypass_cache else load_cached_article(bucket, cache_key)
+        if cached_html:
+            save_article_outputs(
+                bucket, video_info, transcript_key, full_content, cached_html,
+                timestamp_from_transcript_key(transcript_key),
+                {"mode": "cache"},
+                {"key": cache_key, "status": "hit", "prompt_version": ARTICLE_PROMPT_VERSION},
+                normalization_info
+            )
+            cached.append(transcript_key)
+            continue
+        
+        custom_id = f"article-{len(items)}"
+        items.append((custom_id, {
+            "transcript_key": transcript_key,
+            "cache_key": cache_key,
+            "cache_status": "bypass" if bypass_cache else "miss",
+            "normalization": normalization_info
+        }))
+        lines.append(json.dumps(build_batch_request(custom_id, video_info, transcript_text), ensure_ascii=False))
+    
+    if not lines:
+        print("✅ バッチ投入対象なし（全件キャッシュ済みまたは記事作成済み）")
+        return {'batch_ids': [], 'submitted': 0, 'cached': len(cached), 'skipped_existing': len(existing)}
+    
+    ranges = split_batch_lines(lines)
+    if len(ranges) > 1:
+        print(f"✂️ 入力ファイルの上限を超えるため {len(ranges)} バッチに分割します")
+    
+    batch_ids = []
+    for start, end in ranges:
+        batch_ids.append(submit_batch_file(bucket, lines[start:end], dict(items[start:end])))
+    
+    return {'batch_ids': batch_ids, 'submitted': len(items), 'cached': len(cached), 'skipped_existing': len(existing)}
+
+def submit_batch_file(bucket, lines, items):
+    """1つの入力ファイル分のJSONLをBatch APIに投入し、マニフェストをS3に保存"""
+    # JSONLファイルをアップロード
+    jsonl = ('\n'.join(lines) + '\n').encode('utf-8')
+    print(f"📤 バッチ入力ファイルをアップロード中 ({len(lines)}件, {len(jsonl) / 1024:.1f} KB)")
+    response = requests.post(
+        f"{OPENAI_API_BASE}/files",
+        headers=openai_headers(),
+        files={'file': ('article_batch.jsonl', jsonl, 'application/jsonl')},
+        data={'purpose': 'batch'},
+        timeout=120
+    )
+    response.raise_for_status()
+    input_file_id = response.json()['id']
+    
+    # バッチを作成
+    response = requests.post(
+        f"{OPENAI_API_BASE}/batches",
+        headers=openai_headers(),
+        json={
+            "input_file_id": input_file_id,
+            "endpoint": "/v1/chat/completions",
+            "completion_window": BATCH_COMPLETION_WINDOW
+        },
+        timeout=60
+    )
+    response.raise_for_status()
+    batch = response.json()
+    print(f"✅ バッチ投入完了: {batch['id']}")
+    
+    manifest = {
+        "batch_id": batch['id'],
+        "input_file_id": input_file_id,
+        "submitted_at": datetime.now().isoformat(),
+        "status": batch.get('status'),
+        "prompt_version": ARTICLE_PROMPT_VERSION,
+        "items": items
+    }
+    s3.put_object(
+        Bucket=bucket,
+        Key=f"{BATCH_MANIFEST_PREFIX}batch_{batch['id']}.json",
+        Body=json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8'),
+        ContentType='application/json'
+    )
+    
+    return batch['id']
+
+def poll_batch(bucket, batch_id):
+    """バッチの状態を確認し、完了していれば結果を記事として展開"""
+    response = requests.get(f"{OPENAI_API_BASE}/batches/{batch_id}", headers=openai_headers(), timeout=60)
+    response.raise_for_status()
+    batch = response.json()
+    status = batch.get('status')
+    print(f"🔍 バッチ状態: {batch_id} → {status}")
+    
+    if status not in BATCH_FINAL_STATUSES:
+        return {'batch_id': batch_id, 'status': status, 'done': False}
+    
+    manifest_key = f"{BATCH_MANIFEST_PREFIX}batch_{batch_id}.json"
+    manifest = json.loads(s3.get_object(Bucket=bucket, Key=manifest_key)['Body'].read().decode('utf-8'))
+    
+    written, failed = [], []
+    if batch.get('output_file_id'):
+        written, failed = fan_out_results(bucket, batch, manifest)
+    
+    # 出力に含まれなかった項目も失敗として記録
+    missing = set(manifest['items']) - set(written) - set(failed)
+    failed.extend(sorted(missing))
+    
+    manifest.update({
+        "status": status,
+        "completed_at": datetime.now().isoformat(),
+        "written": written,
+        "failed": failed
+    })
+    s3.put_object(
+        Bucket=bucket,
+        Key=manifest_key,
+        Body=json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8'),
+        ContentType='application/json'
+    )
+    
+    print(f"✅ バッチ展開完了: 成功 {len(written)}件 / 失敗 {len(failed)}件")
+    return {'batch_id': batch_id, 'status': status, 'done': True, 'written': len(written), 'failed': len(failed)}
+
+def fan_out_results(bucket, batch, manifest):
+    """バッチ出力ファイルを読み、1件ずつ articles/*.html とメタデータに保存"""
+    response = requests.get(
+        f"{OPENAI_API_BASE}/files/{batch['output_file_id']}/content",
+        headers=openai_headers(),
+        timeout=300
+    )
+    response.raise_for_status()
+    
+    written, failed = [], []
+    for line in response.text.splitlines():
+        if not line.strip():
+            continue
+        
+        result = json.loads(line)
+        custom_id = result.get('custom_id')
+        item = manifest['items'].get(custom_id)
+        if not item:
+            print(f"⚠️ マニフェストにない結果をスキップ: {custom_id}")
+            continue
+        
+        res = result.get('response') or {}
+        if result.get('error') or res.get('status_code') != 200:
+            print(f"❌ 生成失敗: {item['transcript_key']} ({result.get('error') or res.get('status_code')})")
+            failed.append(custom_id)
+            continue
+        
+        try:
+            article = strip_code_fences(res['body']['choices'][0]['message']['content'])
+            video_info, transcript_text, full_content = load_transcript(bucket, item['transcript_key'])
+            
+            save_article_outputs(
+                bucket, video_info, item['transcript_key'], full_content, article,
+                timestamp_from_transcript_key(item['transcript_key']),
+                {"mode": "batch", "batch_id": batch['id']},
+                {"key": item['cache_key'], "status": item['cache_status'], "prompt_version": manifest['prompt_version']},
+                item.get('normalization')
+            )
+            store_cached_article(bucket, item['cache_key'], article)
+            written.append(custom_id)
+        
+        except Exception as e:
+            print(f"❌ 記事保存エラー: {item['transcript_key']} ({e})")
+            failed.append(custom_id)
+    
+    return written, failed
+
+def run_backfill(bucket, transcript_keys, poll_interval=60, bypass_cache=False, skip_existing=True):
+    """投入から展開までを1プロセスで実行（ローカル実行・スタブ試験用）"""
+    submitted = submit_batch(bucket, transcript_keys, bypass_cache=bypass_cache, skip_existing=skip_existing)
+    
+    results = {}
+    pending = list(submitted['batch_ids'])
+    while pending:
+        for batch_id in list(pending):
+            result = poll_batch(bucket, batch_id)
+            if result['done']:
+                results[batch_id] = result
+                pending.remove(batch_id)
+        if pending:
+            time.sleep(poll_interval)
+    
+    return dict(submitted, results=results)
@@ -0,0 +1,62 @@
+"""
+音声抽出（MP3エンコード）の並列化ベンチマーク
+
+使い方:
+    python benchmark_extraction.py lecture.mp4 --workers 1 2 4 6
+
+1プロセスの変換を基準に、プロセス数ごとの処理時間・速度向上率と、
+出力の長さが1プロセス版とどれだけずれるか（連結境界の誤差）を表示する。
+"""
+import argparse
+import os
+import subprocess
+import tempfile
+import time
+
+from extract_transcript_lambda import FFMPEG_PATH, probe_media, transcode_parallel
+
+def serial_transcode(input_path, output_file):
+    cmd = [
+        FFMPEG_PATH, '-v', 'error', '-i', input_path,
+        '-vn', '-acodec', 'mp3', '-ab', '128k', '-ar', '44100',
+        '-y', output_file
+    ]
+    subprocess.run(cmd, check=True, capture_output=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='並列音声抽出のスケーリング計測')
+    parser.add_argument('input_file')
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4, os.cpu_count() or 1])
+    args = parser.parse_args()
+
+    probe = probe_media(args.input_file)
+    if not probe or not probe['duration']:
+        raise SystemExit("入力の長さを取得できません")
+    duration = probe['duration']
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        serial_file = os.path.join(temp_dir, 'serial.mp3')
+        started = time.monotonic()
+        serial_transcode(args.input_file, serial_file)
+        serial_elapsed = time.monotonic() - started
+        serial_duration = probe_media(serial_file)['duration']
+
+        print(f"入力: {args.input_file} ({duration:.1f}秒, CPU {os.cpu_count()}コア)")
+        print(f"{'workers':>7} {'elapsed[s]':>11} {'speedup':>8} {'duration[s]':>12} {'diff[ms]':>9}")
+        print(f"{'serial':>7} {serial_elapsed:>11.1f} {1.0:>8.2f} {serial_duration:>12.3f} {0.0:>9.1f}")
+
+        for workers in sorted(set(args.workers)):
+            if workers < 2:
+                continue
+            output_file = os.path.join(temp_dir, f"parallel_{workers}.mp3")
+            started = time.monotonic()
+            if not transcode_parallel(args.input_file, output_file, duration, workers, temp_dir):
+                print(f"{workers:>7} 失敗")
+                continue
+            elapsed = time.monotonic() - started
+            parallel_duration = probe_media(output_file)['duration']
+            print(f"{workers:>7} {elapsed:>11.1f} {serial_elapsed / elapsed:>8.2f} "
+                  f"{parallel_duration:>12.3f} {(parallel_duration - serial_duration) * 1000:>9.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""
+文字起こしバックエンドのベンチマーク
+
+使い方:
+    python benchmark_transcription.py sample1.mp3 sample2.m4a --backends openai local
+
+各ファイル・バックエンドごとに実時間係数（処理時間 / 音声長）と1回あたりの
+推定コスト（USD）を表示し、--output を指定するとJSONでも保存する。
+"""
+import argparse
+import json
+
+from extract_transcript_lambda import probe_media
+from transcription_backends import BACKENDS, benchmark_backend, get_backend
+
+def main():
+    parser = argparse.ArgumentParser(description='文字起こしバックエンドのRTF・コスト比較')
+    parser.add_argument('audio_files', nargs='+')
+    parser.add_argument('--backends', nargs='+', default=list(BACKENDS), choices=list(BACKENDS))
+    parser.add_argument('--language', default='ja')
+    parser.add_argument('--output', help='結果を保存するJSONファイル')
+    args = parser.parse_args()
+
+    results = []
+    for audio_file in args.audio_files:
+        probe = probe_media(audio_file)
+        audio_seconds = probe['duration'] if probe and probe['duration'] else 0
+
+        for name in args.backends:
+            print(f"⏱️ {name}: {audio_file} ({audio_seconds:.0f}秒)")
+            result = benchmark_backend(get_backend(name), audio_file, audio_seconds, args.language)
+            result['file'] = audio_file
+            results.append(result)
+
+    print()
+    print(f"{'backend':<8} {'audio[s]':>9} {'elapsed[s]':>11} {'RTF':>7} {'cost[USD]':>10}  file")
+    for r in results:
+        rtf = f"{r['real_time_factor']:.3f}" if r['real_time_factor'] is not None else '-'
+        print(f"{r['backend']:<8} {r['audio_seconds']:>9.0f} {r['elapsed_seconds']:>11.1f} "
+              f"{rtf:>7} {r['estimated_cost_usd']:>10.4f}  {r['file']}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,75 @@
 import json
 import boto3
+import math
 import os
 import re
+import shutil
+import subprocess
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import openai
 from urllib.parse import unquote
+from invocation_profiler import profile_handler
+from transcription_backends import select_backend
 # pydubはContainer環境では不要（FFmpegを直接使用）
 
 # AWS clients
 s3 = boto3.client('s3')
 
+# FFmpegバイナリ（Container Imageに同梱）
+FFMPEG_PATH = '/usr/local/bin/ffmpeg'
+FFPROBE_PATH = '/usr/local/bin/ffprobe'
+
+# 音声ファイルの拡張子（変換に失敗しても元ファイルのままWhisperに渡す）
+# 対応可否は拡張子ではなくFFprobeの結果で判断する
+AUDIO_EXTENSIONS = ['.mp3', '.wav', '.m4a', '.aac']
+
+# Whisper APIがそのまま受け付けるコーデック → 出力拡張子
+# （.aac はADTS生ストリームのためWhisperに渡せず、m4aへリマックスする）
+WHISPER_COPY_CODECS = {
+    'mp3': '.mp3',
+    'aac': '.m4a',
+}
+WHISPER_IN_PLACE_EXTENSIONS = {
+    'mp3': ['.mp3'],
+    'aac': ['.m4a'],
+    'pcm_s16le': ['.wav'],
+}
+# Whisper APIのファイルサイズ上限
+WHISPER_MAX_BYTES = 25 * 1024 * 1024
+# ストリームコピー時のコンテナのオーバーヘッド（音声ビットレートからのサイズ推定に加算）
+REMUX_OVERHEAD_RATIO = 1.02
+
+# ダウンロード前の事前検証（presigned URL経由でヘッダーのみFFprobe）
+PREFLIGHT_ENABLED = os.environ.get('PREFLIGHT_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+PREFLIGHT_PROBE_SIZE = 512 * 1024
+PRESIGNED_URL_EXPIRES = 3600
+# FFprobeが入力を解析できなかったことを示すエラー（破損・未対応の形式）→ 事前検証で拒否
+PROBE_INVALID_INPUT_ERRORS = (
+    'moov atom not found',
+    'EBML header parsing failed',
+    'Invalid data found when processing input',
+)
+# S3への接続・転送のエラー → 入力の問題とは限らないため事前検証をスキップ
+PROBE_TRANSPORT_ERRORS = (
+    'server returned', 'http error', 'connection', 'timed out', 'timeout',
+    'input/output error', 'i/o error', 'tls', 'ssl', 'resolve',
+)
+
+# 並列MP3エンコード（0 = CPUコア数に合わせる, 1 = 常に1プロセス）
+AUDIO_EXTRACTION_WORKERS = int(os.environ.get('AUDIO_EXTRACTION_WORKERS', '0'))
+# この長さ未満の音声は分割のオーバーヘッドが勝つため1プロセスで変換
+PARALLEL_EXTRACTION_MIN_SECONDS = int(os.environ.get('PARALLEL_EXTRACTION_MIN_SECONDS', '600'))
+# MP3（44.1kHz）の1フレームの長さ。分割位置をフレーム境界に揃える
+MP3_FRAME_SECONDS = 1152 / 44100
+
+# 音声指紋による重複アップロード検出（audio_fingerprint.py）
+FINGERPRINT_ENABLED = os.environ.get('FINGERPRINT_ENABLED', '').lower() in ('1', 'true', 'yes')
+
+# チャンク単位の文字起こしキャッシュ（transcript_chunk_cache.py）
+TRANSCRIPT_CACHE_ENABLED = os.environ.get('TRANSCRIPT_CACHE_ENABLED', '').lower() in ('1', 'true', 'yes')
+
+@profile_handler('extract_transcript')
 def lambda_handler(event, context):
     """
     Lambda関数1: 動画から音声抽出・文字起こし
@@ -24,6 +83,11 @@ def lambda_handler(event, context):
     - S3に文字起こしファイル保存
     """
     
+    # 分割ジョブのワーカー・結合呼び出し（パートの失敗は再試行・DLQのため例外のまま送出される）
+    if event.get('fanout_action'):
+        from transcript_fanout import handle_fanout_event
+        return handle_fanout_event(event, context)
+    
     try:
         print("🚀 音声抽出・文字起こし処理開始")
         
@@ -36,6 +100,7 @@ def lambda_handler(event, context):
             # メタデータからYouTube URLを取得
             response = s3.head_object(Bucket=bucket, Key=video_key)
             youtube_url = response.get('Metadata', {}).get('youtube-url', '')
+            request_options = {}
             
         else:
             # API Gatewayからの呼び出し
@@ -43,6 +108,7 @@ def lambda_handler(event, context):
             bucket = body.get('bucket')
             video_key = body.get('video_key')
             youtube_url = body.get('youtube_url', '')
+            request_options = body
         
         if not bucket or not video_key:
             raise ValueError("bucket and video_key are required")
@@ -61,22 +127,103 @@ def lambda_handler(event, context):
         # タイムスタンプ生成
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         
+        # ダウンロード前にヘッダーだけを読み、破損・音声なし・未対応の入力を即座に拒否
+        probe = None
+        if PREFLIGHT_ENABLED:
+            probe, reject_reason = preflight_probe(bucket, video_key)
+            if reject_reason:
+                return reject_upload(bucket, video_key, video_id, timestamp, reject_reason, probe)
+        
+        # 長尺動画は時間範囲ごとに分割し、別Invocationで抽出・文字起こし
+        from transcript_fanout import start_fanout_job
+        fanout_job = start_fanout_job(bucket, video_key, youtube_url, video_id, timestamp, context, probe=probe)
+        if fanout_job:
+            return {
+                'statusCode': 202,
+                'body': json.dumps({
+                    'message': '分割処理を開始しました',
+                    'video_id': video_id,
+                    'job_id': fanout_job['job_id'],
+                    'parts': len(fanout_job['segments'])
+                }, ensure_ascii=False)
+            }
+        
         # 一時ディレクトリで処理
         with tempfile.TemporaryDirectory() as temp_dir:
-            # S3から動画ファイルをダウンロード
-            video_path = os.path.join(temp_dir, 'input_video.mp4')
+            # S3から動画ファイルをダウンロード（拡張子は元ファイルに合わせる）
+            source_ext = os.path.splitext(video_key)[1].lower() or '.mp4'
+            video_path = os.path.join(temp_dir, f'input_video{source_ext}')
             print(f"📥 S3から動画ダウンロード中: {video_key}")
             s3.download_file(bucket, video_key, video_path)
             
-            # 音声抽出
-            audio_data = extract_audio_from_file(video_path, temp_dir, video_id)
-            if not audio_data:
-                raise Exception("音声抽出に失敗しました")
-            
-            # S3に音声ファイルをアップロード
-            audio_key = f"audio/{video_id}.mp3"
-            print(f"📤 S3に音声アップロード中: {audio_key}")
-            s3.upload_file(audio_data['file_path'], bucket, audio_key)
+            # 再エンコードが必要な長尺音声は、FFmpegの出力を待たずにセグメント単位で文字起こしを開始
+            # チャンクキャッシュ有効時は変更のないチャンクを再利用するため通常処理を使う
+            from transcription_pipeline import run_transcription_pipeline, should_pipeline
+            pipeline_probe = None if TRANSCRIPT_CACHE_ENABLED else should_pipeline(video_path, probe)
+            fingerprint = None
+            transcript_text = None
+            transcript_cache = None
+            if pipeline_probe:
+                # パイプラインは音声ファイルを作らないため、元ファイルから指紋を計算して照合
+                if FINGERPRINT_ENABLED:
+                    fingerprint, duplicate = check_duplicate_upload(
+                        bucket, video_path, int(pipeline_probe['duration']), request_options
+                    )
+                    if duplicate:
+                        return link_duplicate_upload(bucket, video_key, video_id, timestamp, duplicate)
+                
+                backend = select_backend(
+                    pipeline_probe['duration'],
+                    queue_depth=request_options.get('queue_depth'),
+                    requested=request_options.get('transcription_backend')
+                )
+                # セグメントは audio/{video_id}/part_XXXX.mp3 として保存
+                audio_key = f"audio/{video_id}/"
+                audio_data, transcript_text = run_transcription_pipeline(
+                    video_path, temp_dir, backend,
+                    on_segment=lambda index, path: s3.upload_file(path, bucket, f"{audio_key}part_{index:04d}.mp3")
+                )
+                audio_data['audio_codec'] = pipeline_probe['audio_codec']
+            else:
+                # 音声抽出
+                audio_data = extract_audio_from_file(video_path, temp_dir, video_id, probe)
+                if not audio_data:
+                    raise Exception("音声抽出に失敗しました")
+                
+                # 音声指紋で再エクスポート版などの重複アップロードを検出
+                if FINGERPRINT_ENABLED:
+                    fingerprint, duplicate = check_duplicate_upload(
+                        bucket, audio_data['file_path'], audio_data['duration'], request_options
+                    )
+                    if duplicate:
+                        return link_duplicate_upload(bucket, video_key, video_id, timestamp, duplicate)
+                
+                # S3に音声ファイルをアップロード
+                audio_key = f"audio/{video_id}{audio_data['extension']}"
+                print(f"📤 S3に音声アップロード中: {audio_key}")
+                s3.upload_file(audio_data['file_path'], bucket, audio_key)
+                
+                # 文字起こし（長さ・キューの深さからバックエンドを選択）
+                backend = select_backend(
+                    audio_data['duration'],
+                    queue_depth=request_options.get('queue_depth'),
+                    requested=request_options.get('transcription_backend')
+                )
+                
+                # 編集後の再アップロードでは、変更のあったチャンクだけを文字起こし
+                if TRANSCRIPT_CACHE_ENABLED:
+                    try:
+                        from transcript_chunk_cache import transcribe_with_chunk_cache
+                        transcript_text, _, transcript_cache = transcribe_with_chunk_cache(
+                            bucket, video_path, temp_dir, backend
+                        )
+                    except Exception as e:
+                        print(f"⚠️ チャンクキャッシュでの文字起こしに失敗、通常処理で続行: {e}")
+                
+                if transcript_text is None:
+                    transcript_text = transcribe_audio_text(audio_data['file_path'], backend)
+                if transcript_text is None:
+                    raise Exception("文字起こしに失敗しました")
             
             # 動画情報を設定
             video_info = {
@@ -88,45 +235,43 @@ def lambda_handler(event, context):
                 'url': youtube_url
             }
             
-            # 文字起こし
-            transcript_content = transcribe_audio(audio_data['file_path'], video_info)
-            if not transcript_content:
-                raise Exception("文字起こしに失敗しました")
-            
-            # S3に文字起こしファイルをアップロード
-            transcript_key = f"transcripts/transcript_{video_id}_{timestamp}.txt"
-            print(f"📤 S3に文字起こしアップロード中: {transcript_key}")
-            s3.put_object(
-                Bucket=bucket,
-                Key=transcript_key,
-                Body=transcript_content.encode('utf-8'),
-                ContentType='text/plain'
-            )
+            transcript_content = format_transcript_content(video_info, transcript_text)
             
-            # メタデータファイルを作成
-            metadata = {
-                "video_info": video_info,
-                "processing_info": {
-                    "processed_at": datetime.now().isoformat(),
-                    "status": "transcript_completed",
-                    "lambda_function": "extract_transcript",
+            # S3に文字起こしファイル・メタデータを保存
+            transcript_key, metadata_key = save_transcript_outputs(
+                bucket, video_info, transcript_content, timestamp,
+                {
                     "audio_key": audio_key,
-                    "transcript_key": transcript_key,
+                    "transcription_backend": backend.name,
+                    "preflight_probe": probe,
+                    "audio_extraction": {
+                        "mode": audio_data['extraction_mode'],
+                        "source_codec": audio_data['audio_codec'],
+                        "workers": audio_data['extraction_workers'],
+                        "pipeline": audio_data.get('pipeline')
+                    },
+                    "transcript_cache": transcript_cache,
                     "file_sizes": {
                         "audio_mb": audio_data['file_size_mb'],
                         "transcript_length": len(transcript_content)
                     }
                 }
-            }
-            
-            metadata_key = f"metadata/extract_{video_id}_{timestamp}.json"
-            s3.put_object(
-                Bucket=bucket,
-                Key=metadata_key,
-                Body=json.dumps(metadata, ensure_ascii=False, indent=2).encode('utf-8'),
-                ContentType='application/json'
             )
             
+            # 後続のアップロードと照合できるよう指紋を登録
+            if fingerprint is not None:
+                try:
+                    from audio_fingerprint import register_fingerprint
+                    register_fingerprint(bucket, fingerprint, {
+                        "video_key": video_key,
+                        "video_id": video_id,
+                        "duration": audio_data['duration'],
+                        "transcript_key": transcript_key,
+                        "metadata_key": metadata_key
+                    })
+                except Exception as e:
+                    print(f"⚠️ 音声指紋の登録に失敗: {e}")
+            
             print("✅ 音声抽出・文字起こし完了！")
             
             return {
@@ -149,6 +294,134 @@ def lambda_handler(event, context):
             }, ensure_ascii=False)
         }
 
+def check_duplicate_upload(bucket, audio_path, duration, request_options):
+    """音声指紋を計算し、登録済みの動画と照合
+    
+    編集版を意図して再処理する場合はイベントの skip_duplicate_check で照合を省略する（指紋の登録は行う）。
+    
+    Returns:
+        (指紋, 重複先の登録情報) - 照合に失敗した場合は (None, None) で通常処理に任せる
+    """
+    try:
+        from audio_fingerprint import fingerprint_audio, find_duplicate
+        fingerprint = fingerprint_audio(audio_path)
+        if request_options.get('skip_duplicate_check'):
+            print("⏭️ 重複チェックをスキップ")
+            return fingerprint, None
+        return fingerprint, find_duplicate(bucket, fingerprint, duration)
+    except Exception as e:
+        print(f"⚠️ 音声指紋の照合に失敗、通常処理で続行: {e}")
+        return None, None
+
+def find_article_for_transcript(bucket, video_id, transcript_key):
+    """文字起こしから生成された記事のキーを記事メタデータから探す（未生成ならNone）
+    
+    metadata/article_[ID]_*.json を新しい順に読み、transcript_key が一致するものを返す。
+    """
+    paginator = s3.get_paginator('list_objects_v2')
+    objects = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"metadata/article_{video_id}_"):
+        objects.extend(page.get('Contents', []))
+    
+    for obj in sorted(objects, key=lambda o: o['LastModified'], reverse=True):
+        response = s3.get_object(Bucket=bucket, Key=obj['Key'])
+        processing_info = json.loads(response['Body'].read().decode('utf-8')).get('processing_info', {})
+        if processing_info.get('transcript_key') == transcript_key:
+            return processing_info.get('article_key')
+    return None
+
+def link_duplicate_upload(bucket, video_key, video_id, timestamp, duplicate):
+    """重複アップロードは文字起こし・記事を再生成せず既存の成果物に紐づける
+    
+    transcripts/ には書き込まないため後続の記事生成は起動しない。
+    既存の記事は紐づけ先の文字起こしの記事メタデータから特定して記録する。
+    """
+    try:
+        article_key = find_article_for_transcript(bucket, duplicate['video_id'], duplicate['transcript_key'])
+    except Exception as e:
+        print(f"⚠️ 既存記事の特定に失敗: {e}")
+        article_key = None
+    
+    metadata = {
+        "video_info": {
+            "id": video_id,
+            "title": f"動画 ({os.path.basename(video_key)})",
+            "video_key": video_key
+        },
+        "processing_info": {
+            "processed_at": datetime.now().isoformat(),
+            "status": "duplicate_linked",
+            "lambda_function": "extract_transcript",
+            "transcript_key": duplicate['transcript_key'],
+            "article_key": article_key,
+            "duplicate_of": duplicate
+        }
+    }
+    
+    metadata_key = f"metadata/extract_{video_id}_{timestamp}.json"
+    s3.put_object(
+        Bucket=bucket,
+        Key=metadata_key,
+        Body=json.dumps(metadata, ensure_ascii=False, indent=2).encode('utf-8'),
+        ContentType='application/json'
+    )
+    
+    print(f"♻️ 重複アップロードのため既存の文字起こしに紐づけ: {duplicate['transcript_key']}")
+    if article_key:
+        print(f"   既存の記事: {article_key}")
+    else:
+        print("   既存の記事は未生成です")
+    
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': '重複動画のため既存の文字起こしに紐づけました',
+            'video_id': video_id,
+            'transcript_key': duplicate['transcript_key'],
+            'article_key': article_key,
+            'duplicate_of': duplicate['video_key'],
+            'metadata_key': metadata_key
+        }, ensure_ascii=False)
+    }
+
+def save_transcript_outputs(bucket, video_info, transcript_content, timestamp, processing_extra):
+    """文字起こしファイルとメタデータをS3に保存
+    
+    Returns:
+        (transcript_key, metadata_key)
+    """
+    video_id = video_info['id']
+    transcript_key = f"transcripts/transcript_{video_id}_{timestamp}.txt"
+    print(f"📤 S3に文字起こしアップロード中: {transcript_key}")
+    s3.put_object(
+        Bucket=bucket,
+        Key=transcript_key,
+        Body=transcript_content.encode('utf-8'),
+        ContentType='text/plain'
+    )
+    
+    # メタデータファイルを作成
+    metadata = {
+        "video_info": video_info,
+        "processing_info": {
+            "processed_at": datetime.now().isoformat(),
+            "status": "transcript_completed",
+            "lambda_function": "extract_transcript",
+            "transcript_key": transcript_key,
+            **processing_extra
+        }
+    }
+    
+    metadata_key = f"metadata/extract_{video_id}_{timestamp}.json"
+    s3.put_object(
+        Bucket=bucket,
+        Key=metadata_key,
+        Body=json.dumps(metadata, ensure_ascii=False, indent=2).encode('utf-8'),
+        ContentType='application/json'
+    )
+    
+    return transcript_key, metadata_key
+
 def extract_video_id(youtube_url):
     """YouTube URLから動画IDを抽出"""
     if not youtube_url:
@@ -165,81 +438,352 @@ def extract_video_id(youtube_url):
             return match.group(1)
     return None
 
-def extract_audio_from_file(video_path, output_dir, video_id):
-    """動画ファイルから音声を抽出（FFmpeg Container対応）"""
+def probe_media(file_path, probesize=None):
+    """FFprobeでコンテナ・音声コーデック・長さを一度に取得
+    
+    file_path にはローカルパスのほかpresigned URLも渡せる（必要な範囲だけRange読み込みされる）。
+    """
+    return run_ffprobe(file_path, probesize)[0]
+
+def run_ffprobe(file_path, probesize=None):
+    """FFprobeを実行し、解析結果とエラー出力を返す
+    
+    Returns:
+        (probe, stderr) - 解析できなければprobeはNone
+    """
+    cmd = [
+        FFPROBE_PATH, '-v', 'error', '-print_format', 'json',
+        '-show_entries', 'format=format_name,duration:stream=codec_type,codec_name,bit_rate'
+    ]
+    if probesize:
+        cmd += ['-probesize', str(probesize), '-analyzeduration', '0']
+    cmd.append(file_path)
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+        if result.returncode != 0 or not result.stdout.strip():
+            print(f"⚠️ FFprobe失敗: {result.stderr}")
+            return None, result.stderr
+        
+        info = json.loads(result.stdout)
+        streams = info.get('streams', [])
+        audio_streams = [st for st in streams if st.get('codec_type') == 'audio']
+        fmt = info.get('format', {})
+        
+        try:
+            duration = float(fmt.get('duration'))
+        except (TypeError, ValueError):
+            duration = None
+        try:
+            audio_bitrate = int(audio_streams[0].get('bit_rate'))
+        except (IndexError, TypeError, ValueError):
+            audio_bitrate = None
+        
+        return {
+            'format_name': fmt.get('format_name', ''),
+            'duration': duration,
+            'audio_codec': audio_streams[0].get('codec_name') if audio_streams else None,
+            'audio_bitrate': audio_bitrate,
+            'has_video': any(st.get('codec_type') == 'video' for st in streams)
+        }, result.stderr
+        
+    except Exception as e:
+        print(f"⚠️ FFprobe実行エラー: {e}")
+        return None, str(e)
+
+def invalid_input_error(stderr):
+    """FFprobeのエラー出力が入力自体の問題（破損・未対応）を示していればそのエラーを返す
+    
+    S3への接続・転送エラーを含む場合は入力の問題と断定できないためNone。
+    エラー行にはpresigned URLが含まれるため、該当したエラー文言のみを返す。
+    """
+    if not stderr:
+        return None
+    lowered = stderr.lower()
+    if any(marker in lowered for marker in PROBE_TRANSPORT_ERRORS):
+        return None
+    for marker in PROBE_INVALID_INPUT_ERRORS:
+        if marker in stderr:
+            return marker
+    return None
+
+def choose_extraction_mode(file_ext, probe, file_size):
+    """入力の拡張子とコーデックから最小コストの抽出方法を選択
+    
+    Returns:
+        (mode, 出力拡張子) - mode は 'in_place' / 'remux' / 'transcode'
+    """
+    codec = probe.get('audio_codec') if probe else None
+    
+    if codec:
+        # 音声ファイルでWhisperがそのまま受け付ける形式はコピーすら不要
+        if (not probe['has_video']
+                and file_ext in WHISPER_IN_PLACE_EXTENSIONS.get(codec, [])
+                and file_size <= WHISPER_MAX_BYTES):
+            return 'in_place', file_ext
+        
+        # 互換コーデックはストリームコピーでコンテナのみ変更
+        # ただし元のビットレートのままWhisperの上限を超える場合は128kのMP3に再エンコード
+        if codec in WHISPER_COPY_CODECS:
+            estimated = estimate_remux_bytes(probe)
+            if estimated is None or estimated <= WHISPER_MAX_BYTES:
+                return 'remux', WHISPER_COPY_CODECS[codec]
+            print(f"⚠️ ストリームコピー後の推定サイズ {estimated / (1024 * 1024):.1f} MB がWhisperの上限を超えるため再エンコード")
+    
+    return 'transcode', '.mp3'
+
+def estimate_remux_bytes(probe):
+    """ストリームコピー後のサイズを音声ビットレートと長さから推定（不明ならNone）"""
+    if not probe.get('audio_bitrate') or not probe.get('duration'):
+        return None
+    return int(probe['audio_bitrate'] * probe['duration'] / 8 * REMUX_OVERHEAD_RATIO)
+
+def extraction_workers(probe):
+    """再エンコード時に使うFFmpegプロセス数を決める"""
+    if not probe or not probe['duration'] or probe['duration'] < PARALLEL_EXTRACTION_MIN_SECONDS:
+        return 1
+    workers = AUDIO_EXTRACTION_WORKERS or os.cpu_count() or 1
+    # 1パートが短くなりすぎないよう上限を設ける
+    return max(1, min(workers, int(probe['duration'] // 60)))
+
+def plan_extraction_ranges(duration, workers):
+    """MP3フレーム境界に揃えた時間範囲に分割"""
+    frames = math.ceil(duration / MP3_FRAME_SECONDS)
+    frames_per_part = math.ceil(frames / workers)
+    ranges = []
+    for i in range(workers):
+        start = i * frames_per_part * MP3_FRAME_SECONDS
+        if start >= duration:
+            break
+        ranges.append((start, frames_per_part * MP3_FRAME_SECONDS))
+    return ranges
+
+def transcode_parallel(input_path, output_file, duration, workers, work_dir):
+    """時間範囲ごとに複数のFFmpegでMP3エンコードし、ストリームコピーで連結
+    
+    MP3エンコードはほぼシングルスレッドのため、範囲分割でコア数に応じて高速化する。
+    連結は再エンコードなし（concat demuxer + -c copy）で、各境界の誤差は
+    エンコーダ遅延分（1フレーム未満）に収まる。失敗時はFalseを返し1プロセスで変換し直す。
+    """
+    ranges = plan_extraction_ranges(duration, workers)
+    print(f"⚡ 並列エンコード: {len(ranges)}プロセス ({duration:.0f}秒)")
+    
+    part_files = [os.path.join(work_dir, f"extract_part_{i:03d}.mp3") for i in range(len(ranges))]
+    
+    def encode(i):
+        start, length = ranges[i]
+        cmd = [
+            FFMPEG_PATH, '-v', 'error',
+            '-ss', f"{start:.6f}", '-t', f"{length:.6f}", '-i', input_path,
+            '-vn', '-acodec', 'mp3', '-ab', '128k', '-ar', '44100',
+            '-threads', '1', '-write_xing', '0',
+            '-y', part_files[i]
+        ]
+        return subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+    
+    list_file = os.path.join(work_dir, 'extract_parts.txt')
+    try:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+            results = list(pool.map(encode, range(len(ranges))))
+        
+        failed = [r.stderr for r in results if r.returncode != 0]
+        if failed:
+            print(f"⚠️ 並列エンコードに失敗、1プロセスで再実行: {failed[0][-500:]}")
+            return False
+        
+        with open(list_file, 'w') as f:
+            for part in part_files:
+                f.write(f"file '{part}'\n")
+        
+        cmd = [
+            FFMPEG_PATH, '-v', 'error', '-f', 'concat', '-safe', '0', '-i', list_file,
+            '-c', 'copy', '-y', output_file
+        ]
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
+        if result.returncode != 0:
+            print(f"⚠️ 音声の連結に失敗、1プロセスで再実行: {result.stderr[-500:]}")
+            return False
+        
+        print(f"✅ 並列エンコード完了")
+        return True
+        
+    except Exception as e:
+        print(f"⚠️ 並列エンコードエラー、1プロセスで再実行: {e}")
+        return False
+    
+    finally:
+        for path in part_files + [list_file]:
+            if os.path.exists(path):
+                os.remove(path)
+
+def presigned_source_url(bucket, key):
+    """FFmpeg/FFprobeがRangeリクエストで読めるpresigned URLを発行"""
+    return s3.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': bucket, 'Key': key},
+        ExpiresIn=PRESIGNED_URL_EXPIRES
+    )
+
+def preflight_probe(bucket, video_key):
+    """ダウンロード前にヘッダー（MP4は末尾のmoovも）だけを読んで入力を検証
+    
+    拒否するのは、FFprobeのデマルチプレクサが入力を解析できなかった場合（破損・未対応の形式）と、
+    解析でき音声トラックがないと確認できた場合。S3への接続・転送エラーやタイムアウトでは
+    事前解析をスキップし、長さがヘッダーにない場合（MediaRecorderのWebMなど）は長さ不明のまま続行する。
+    
+    Returns:
+        (probe, 拒否理由) - 問題なければ拒否理由はNone。
+        事前解析できない場合は (None, None) で通常処理に任せる。
+    """
+    try:
+        url = presigned_source_url(bucket, video_key)
+    except Exception as e:
+        print(f"⚠️ 事前解析をスキップ: {e}")
+        return None, None
+    
+    print(f"🔍 事前解析中（ヘッダーのみ読み込み）: {video_key}")
+    probe, stderr = run_ffprobe(url, probesize=PREFLIGHT_PROBE_SIZE)
+    if not probe or not probe['audio_codec']:
+        # 先頭だけでは形式や音声ストリームを判別できない入力（MPEG-TSなど）があるため、既定の範囲で再確認
+        probe, stderr = run_ffprobe(url)
+    
+    if not probe:
+        error = invalid_input_error(stderr)
+        if error:
+            return None, f"破損しているか未対応の形式です: {error}"
+        print("⚠️ 事前解析できないため、ダウンロード後の通常処理で続行")
+        return None, None
+    
+    if not probe['audio_codec']:
+        return probe, "音声トラックがありません"
+    
+    if probe['duration']:
+        print(f"✅ 事前解析OK: {probe['format_name']} / {probe['audio_codec']} / {probe['duration']:.0f}秒")
+    else:
+        print(f"✅ 事前解析OK: {probe['format_name']} / {probe['audio_codec']} / 長さ不明")
+    return probe, None
+
+def reject_upload(bucket, video_key, video_id, timestamp, reason, probe):
+    """事前検証で不正と判定した入力をメタデータに記録して処理を終了"""
+    metadata = {
+        "video_info": {
+            "id": video_id,
+            "title": f"動画 ({os.path.basename(video_key)})",
+            "video_key": video_key
+        },
+        "processing_info": {
+            "processed_at": datetime.now().isoformat(),
+            "status": "rejected",
+            "lambda_function": "extract_transcript",
+            "reason": reason,
+            "probe": probe
+        }
+    }
+    
+    metadata_key = f"metadata/extract_{video_id}_{timestamp}.json"
+    s3.put_object(
+        Bucket=bucket,
+        Key=metadata_key,
+        Body=json.dumps(metadata, ensure_ascii=False, indent=2).encode('utf-8'),
+        ContentType='application/json'
+    )
+    
+    print(f"❌ 入力を拒否: {reason}")
+    
+    return {
+        'statusCode': 422,
+        'body': json.dumps({
+            'error': reason,
+            'video_id': video_id,
+            'metadata_key': metadata_key
+        }, ensure_ascii=False)
+    }
+
+def extract_audio_from_file(video_path, output_dir, video_id, probe=None):
+    """動画ファイルから音声を抽出（FFmpeg Container対応）
+    
+    入力を一度だけFFprobeし、Whisper互換の音声はそのまま使用、
+    互換コーデックはストリームコピー（-c:a copy）、それ以外のみMP3に再エンコードする。
+    """
     print(f"🎵 音声処理中: {video_path}")
     
     # ファイル拡張子を確認
     file_ext = os.path.splitext(video_path)[1].lower()
-    output_file = os.path.join(output_dir, f"{video_id}.mp3")
     
-    if file_ext in ['.mp3', '.wav', '.m4a', '.aac']:
-        # 既に音声ファイルの場合はコピー
-        print(f"🔄 音声ファイルをコピー中...")
-        import shutil
-        shutil.copy2(video_path, output_file)
+    # 事前解析の結果があれば再度FFprobeしない（長さが取れていない場合のみダウンロード済みファイルで再取得）
+    if probe is None or not probe['duration']:
+        probe = probe_media(video_path) or probe
+    if probe and not probe['audio_codec']:
+        print("❌ 音声トラックが見つかりません")
+        return None
+    
+    mode, out_ext = choose_extraction_mode(file_ext, probe, os.path.getsize(video_path))
+    audio_codec = probe['audio_codec'] if probe else None
+    print(f"🔍 音声コーデック: {audio_codec or '不明'} → 処理方法: {mode}")
+    
+    if mode == 'in_place':
+        # 一時ディレクトリ内の入力ファイルをそのまま使用
+        output_file = video_path
+        print(f"✅ 変換不要のため元ファイルを使用: {file_ext}")
+    
+    else:
+        output_file = os.path.join(output_dir, f"{video_id}{out_ext}")
+        transcode_args = ['-acodec', 'mp3', '-ab', '128k', '-ar', '44100']
+        if mode == 'remux':
+            print(f"🔧 FFmpegで音声ストリームをコピー中: {file_ext} → {out_ext}")
+            codec_args = ['-c:a', 'copy']
+        else:
+            print(f"🔧 FFmpegで音声をMP3に変換中: {file_ext or '(拡張子なし)'}")
+            codec_args = transcode_args
         
-        # ファイル名をMP3に統一
-        if file_ext != '.mp3':
-            temp_output = os.path.join(output_dir, f"{video_id}_temp{file_ext}")
-            shutil.move(output_file, temp_output)
-            
-            # FFmpegで形式変換
+        workers = extraction_workers(probe) if mode == 'transcode' else 1
+        if workers > 1 and transcode_parallel(video_path, output_file, probe['duration'], workers, output_dir):
+            mode = 'transcode_parallel'
+        else:
+            workers = 1
             try:
-                import subprocess
                 cmd = [
-                    '/usr/local/bin/ffmpeg', '-i', temp_output,
-                    '-acodec', 'mp3', '-ab', '128k', '-ar', '44100',
-                    '-y', output_file
+                    FFMPEG_PATH, '-i', video_path,
+                    '-vn',  # 映像なし
+                    *codec_args,
+                    '-y',  # 上書き
+                    output_file
                 ]
+                
                 result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
                 
+                # ストリームコピーできないコンテナの組み合わせ、またはビットレート不明で
+                # コピー後にWhisperの上限を超えた場合はMP3への再エンコードで再試行
+                retry_reason = None
+                if mode == 'remux' and result.returncode != 0:
+                    retry_reason = f"ストリームコピーに失敗: {result.stderr[-300:]}"
+                elif mode == 'remux' and os.path.getsize(output_file) > WHISPER_MAX_BYTES:
+                    retry_reason = "ストリームコピー後のサイズがWhisperの上限を超えました"
+                    os.remove(output_file)
+                if retry_reason:
+                    print(f"⚠️ {retry_reason}、MP3に再エンコードします")
+                    mode, out_ext = 'transcode', '.mp3'
+                    output_file = os.path.join(output_dir, f"{video_id}{out_ext}")
+                    cmd = [FFMPEG_PATH, '-i', video_path, '-vn', *transcode_args, '-y', output_file]
+                    result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+                
                 if result.returncode != 0:
-                    print(f"⚠️ 形式変換に失敗、元ファイルを使用: {result.stderr}")
-                    shutil.move(temp_output, output_file)
+                    print(f"❌ FFmpeg音声抽出エラー: {result.stderr}")
+                    if file_ext not in AUDIO_EXTENSIONS:
+                        return None
+                    # 音声ファイルは変換に失敗しても元ファイルで続行
+                    print("⚠️ 形式変換に失敗、元ファイルを使用")
+                    output_file = os.path.join(output_dir, f"{video_id}{file_ext}")
+                    shutil.copy2(video_path, output_file)
+                    mode, out_ext = 'in_place', file_ext
                 else:
-                    os.remove(temp_output)
-                    print(f"✅ {file_ext} から MP3 に変換完了")
-                    
-            except Exception as e:
-                print(f"⚠️ 形式変換エラー、元ファイルを使用: {e}")
-                shutil.move(temp_output, output_file)
-    
-    elif file_ext in ['.mp4', '.avi', '.mov', '.mkv', '.webm', '.flv', '.wmv']:
-        # 動画ファイルの場合はFFmpegで音声抽出
-        print(f"🔧 FFmpegで動画から音声抽出中: {file_ext}")
-        
-        try:
-            import subprocess
-            cmd = [
-                '/usr/local/bin/ffmpeg', '-i', video_path,
-                '-vn',  # 映像なし
-                '-acodec', 'mp3',  # MP3エンコード
-                '-ab', '128k',  # ビットレート
-                '-ar', '44100',  # サンプリングレート
-                '-y',  # 上書き
-                output_file
-            ]
-            
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+                    print(f"✅ FFmpegで音声抽出完了")
             
-            if result.returncode != 0:
-                print(f"❌ FFmpeg音声抽出エラー: {result.stderr}")
+            except subprocess.TimeoutExpired:
+                print("❌ FFmpeg実行がタイムアウトしました")
+                return None
+            except Exception as e:
+                print(f"❌ 音声抽出エラー: {str(e)}")
                 return None
-                
-            print(f"✅ FFmpegで音声抽出完了")
-            
-        except subprocess.TimeoutExpired:
-            print("❌ FFmpeg実行がタイムアウトしました")
-            return None
-        except Exception as e:
-            print(f"❌ 音声抽出エラー: {str(e)}")
-            return None
-    
-    else:
-        print(f"❌ 未対応のファイル形式: {file_ext}")
-        print("💡 対応形式: 動画(.mp4,.avi,.mov,.mkv,.webm,.flv,.wmv) 音声(.mp3,.wav,.m4a,.aac)")
-        return None
     
     # ファイル情報を取得
     if not os.path.exists(output_file):
@@ -248,26 +792,13 @@ def extract_audio_from_file(video_path, output_dir, video_id):
         
     file_size_mb = os.path.getsize(output_file) / (1024 * 1024)
     
-    # 音声の長さを取得（FFprobeで）
-    try:
-        import subprocess
-        cmd = [
-            '/usr/local/bin/ffprobe', '-v', 'quiet', '-show_entries',
-            'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1',
-            output_file
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
-        
-        if result.returncode == 0 and result.stdout.strip():
-            duration = int(float(result.stdout.strip()))
-        else:
-            # フォールバック: ファイルサイズから推定
-            duration = int(file_size_mb * 8)  # 1MB ≈ 8秒
-            print(f"⚠️ FFprobe失敗、推定時間を使用: {duration}秒")
-            
-    except Exception as e:
-        duration = int(file_size_mb * 8)
-        print(f"⚠️ 音声長取得失敗、推定時間を使用: {e}")
+    # 音声の長さ（ストリームコピー・再エンコードでも長さは入力と同じ）
+    if probe and probe['duration']:
+        duration = int(probe['duration'])
+    else:
+        # フォールバック: ファイルサイズから推定
+        duration = int(file_size_mb * 8)  # 1MB ≈ 8秒
+        print(f"⚠️ FFprobe失敗、推定時間を使用: {duration}秒")
     
     print(f"✅ 音声処理完了: {output_file}")
     print(f"    📊 ファイルサイズ: {file_size_mb:.1f} MB")
@@ -277,35 +808,44 @@ def extract_audio_from_file(video_path, output_dir, video_id):
         'file_path': output_file,
         'video_id': video_id,
         'duration': duration,
-        'file_size_mb': file_size_mb
+        'file_size_mb': file_size_mb,
+        'extension': out_ext,
+        'audio_codec': audio_codec,
+        'extraction_mode': mode,
+        'extraction_workers': workers if mode != 'in_place' else 0
     }
 
-def transcribe_audio(audio_file_path, video_info):
+def transcribe_audio(audio_file_path, video_info, backend=None):
     """音声を文字起こし"""
+    transcript_text = transcribe_audio_text(audio_file_path, backend)
+    if transcript_text is None:
+        return None
+    
+    return format_transcript_content(video_info, transcript_text)
+
+def transcribe_audio_text(audio_file_path, backend=None):
+    """音声ファイルを文字起こしし、本文テキストのみを返す
+    
+    backend 未指定時は TRANSCRIPTION_BACKEND の設定に従う（既定はOpenAI Whisper API）。
+    """
     print(f"📝 文字起こし中: {audio_file_path}")
     
-    # OpenAI 0.28.0 安定版での初期化
-    try:
-        openai.api_key = os.environ['OPENAI_API_KEY']
-        print(f"✅ OpenAI初期化成功 (バージョン: {openai.__version__})")
-    except Exception as e:
-        print(f"❌ OpenAI初期化エラー: {str(e)}")
-        raise
+    if backend is None:
+        backend = select_backend(duration=0)
     
     try:
-        with open(audio_file_path, 'rb') as audio_file:
-            # OpenAI 0.28.0 旧API形式（安定版）
-            transcript = openai.Audio.transcribe(
-                model="whisper-1",
-                file=audio_file,
-                language="ja"
-            )
-            
-        transcript_text = transcript.get('text', '')
-        print(f"✅ 文字起こし完了 ({len(transcript_text)}文字)")
+        result = backend.transcribe(audio_file_path, language="ja")
+        transcript_text = result['text']
+        print(f"✅ 文字起こし完了 ({len(transcript_text)}文字, バックエンド: {backend.name})")
+        return transcript_text
         
-        # フォーマットされた文字起こしファイルを生成
-        transcript_content = f"""動画タイトル: {video_info['title']}
+    except Exception as e:
+        print(f"❌ 文字起こしエラー: {str(e)}")
+        return None
+
+def format_transcript_content(video_info, transcript_text):
+    """フォーマットされた文字起こしファイルを生成"""
+    return f"""動画タイトル: {video_info['title']}
 URL: {video_info['url']}
 投稿者: {video_info['uploader']}
 投稿日: {video_info['upload_date']}
@@ -318,9 +858,3 @@ URL: {video_info['url']}
 
 {transcript_text}
 """
-        
-        return transcript_content
-        
-    except Exception as e:
-        print(f"❌ 文字起こしエラー: {str(e)}")
-        return None
\ No newline at end of file
@@ -1,14 +1,35 @@
 import json
 import boto3
+import hashlib
 import os
 import re
+import time
+import unicodedata
 from datetime import datetime
 import openai
 from urllib.parse import unquote
+from invocation_profiler import profile_handler
+from request_hedging import HEDGING_ENABLED, hedge_stats, hedged_call
+from transcript_normalizer import NORMALIZATION_ENABLED, normalize_transcript
 
 # AWS clients
 s3 = boto3.client('s3')
 
+# 記事生成の設定
+ARTICLE_MODEL = "gpt-4-turbo"
+ARTICLE_MAX_TOKENS = 3000
+ARTICLE_TEMPERATURE = 0.7
+
+# build_article_messages のプロンプトを変更したら必ず更新する（記事キャッシュのキーに含まれる）
+ARTICLE_PROMPT_VERSION = "v1"
+
+# 生成済み記事キャッシュの保存先
+ARTICLE_CACHE_PREFIX = "cache/articles/"
+
+# ストリーミング生成の途中経過を保存する間隔（秒）
+STREAM_FLUSH_INTERVAL = float(os.environ.get('ARTICLE_STREAM_FLUSH_SECONDS', '10'))
+
+@profile_handler('generate_article')
 def lambda_handler(event, context):
     """
     Lambda関数2: 文字起こしファイルからHTML記事生成
@@ -52,61 +73,88 @@ def lambda_handler(event, context):
         print(f"   動画ID: {video_info['id']}")
         print(f"   文字起こし長: {len(transcript_text):,}文字")
         
-        # HTML記事生成
-        html_content = generate_article(video_info, transcript_text)
+        # フィラー・繰り返しを除去してプロンプトを短縮（イベント指定 > 環境変数）
+        # 生の文字起こしは transcript_key にそのまま残し、監査時に参照できるようにする
+        normalize = event.get('normalize')
+        if normalize is None:
+            normalize = NORMALIZATION_ENABLED
         
-        if not html_content:
-            raise Exception("記事生成に失敗しました")
+        normalization_info = None
+        if normalize:
+            transcript_text, normalization_info = normalize_transcript(transcript_text)
+            normalization_info['raw_transcript_key'] = transcript_key
+            print(f"🧹 文字起こし正規化: {normalization_info['tokens_before']:,} → {normalization_info['tokens_after']:,}トークン "
+                  f"(-{normalization_info['token_reduction_ratio']:.1%}, {normalization_info['elapsed_ms']}ms)")
         
         # タイムスタンプ生成
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        
-        # S3にHTML記事ファイルをアップロード
         article_key = f"articles/article_{video_info['id']}_{timestamp}.html"
-        print(f"📤 S3にHTML記事アップロード中: {article_key}")
-        s3.put_object(
-            Bucket=bucket,
-            Key=article_key,
-            Body=html_content.encode('utf-8'),
-            ContentType='text/html'
-        )
+        partial_key = f"partial/article_{video_info['id']}_{timestamp}.html.part"
         
-        # メタデータファイルを更新
-        metadata = {
-            "video_info": {
-                "video_id": video_info['id'],
-                "title": video_info['title'],
-                "uploader": video_info['uploader'],
-                "duration": video_info['duration'],
-                "upload_date": video_info['upload_date'],
-                "url": video_info['url'],
-                "thumbnail": f"https://i.ytimg.com/vi/{video_info['id']}/maxresdefault.jpg"
-            },
-            "processing_info": {
-                "processed_at": datetime.now().isoformat(),
-                "status": "article_completed",
-                "lambda_function": "generate_article",
-                "transcript_key": transcript_key,
-                "article_key": article_key,
-                "file_sizes": {
-                    "transcript_length": len(full_content),
-                    "article_length": len(html_content)
-                }
-            },
-            "system_info": {
-                "python_version": "3.11",
-                "openai_model_gpt": "gpt-4-turbo"
-            }
+        # ストリーミングモード（イベント指定 > 環境変数）
+        use_stream = event.get('stream')
+        if use_stream is None:
+            use_stream = os.environ.get('ARTICLE_STREAMING', '').lower() in ('1', 'true', 'yes')
+        
+        # 記事キャッシュ（イベント指定 > 環境変数でバイパス）
+        bypass_cache = event.get('bypass_cache')
+        if bypass_cache is None:
+            bypass_cache = os.environ.get('ARTICLE_CACHE_BYPASS', '').lower() in ('1', 'true', 'yes')
+        
+        cache_key = article_cache_key(video_info, transcript_text)
+        cached_html = None if bypass_cache else load_cached_article(bucket, cache_key)
+        cache_info = {
+            "key": cache_key,
+            "status": "bypass" if bypass_cache else ("hit" if cached_html else "miss"),
+            "prompt_version": ARTICLE_PROMPT_VERSION
         }
         
-        metadata_key = f"metadata/article_{video_info['id']}_{timestamp}.json"
-        s3.put_object(
-            Bucket=bucket,
-            Key=metadata_key,
-            Body=json.dumps(metadata, ensure_ascii=False, indent=2).encode('utf-8'),
-            ContentType='application/json'
+        # HTML記事生成
+        if cached_html:
+            print(f"♻️ キャッシュ済み記事を再利用: {cache_key}")
+            html_content = cached_html
+            generation_stats = {"mode": "cache"}
+        elif use_stream:
+            def flush_partial(partial_html):
+                s3.put_object(
+                    Bucket=bucket,
+                    Key=partial_key,
+                    Body=partial_html.encode('utf-8'),
+                    ContentType='text/plain'
+                )
+            
+            html_content, generation_stats = generate_article_stream(
+                video_info, transcript_text, flush_callback=flush_partial
+            )
+        else:
+            started = time.monotonic()
+            html_content = generate_article(video_info, transcript_text)
+            generation_stats = {
+                "mode": "sync",
+                "total_generation_sec": round(time.monotonic() - started, 3)
+            }
+            if HEDGING_ENABLED:
+                generation_stats['hedging'] = hedge_stats()
+        
+        if not html_content:
+            raise Exception("記事生成に失敗しました")
+        
+        # S3にHTML記事ファイル・メタデータを保存
+        metadata_key = save_article_outputs(
+            bucket, video_info, transcript_key, full_content, html_content,
+            timestamp, generation_stats, cache_info, normalization_info
         )
         
+        if cache_info['status'] != 'hit':
+            store_cached_article(bucket, cache_key, html_content)
+        
+        # 完成版を保存したので途中経過ファイルは削除
+        if generation_stats.get('partial_flushes'):
+            try:
+                s3.delete_object(Bucket=bucket, Key=partial_key)
+            except Exception as e:
+                print(f"⚠️ 途中経過ファイルの削除に失敗: {e}")
+        
         print("✅ HTML記事生成完了！")
         
         return {
@@ -129,6 +177,59 @@ def lambda_handler(event, context):
             }, ensure_ascii=False)
         }
 
+def save_article_outputs(bucket, video_info, transcript_key, full_content, html_content,
+                         timestamp, generation_stats, cache_info, normalization_info=None):
+    """HTML記事とメタデータをS3に保存（メタデータキーを返す）"""
+    article_key = f"articles/article_{video_info['id']}_{timestamp}.html"
+    print(f"📤 S3にHTML記事アップロード中: {article_key}")
+    s3.put_object(
+        Bucket=bucket,
+        Key=article_key,
+        Body=html_content.encode('utf-8'),
+        ContentType='text/html'
+    )
+    
+    # メタデータファイルを更新
+    metadata = {
+        "video_info": {
+            "video_id": video_info['id'],
+            "title": video_info['title'],
+            "uploader": video_info['uploader'],
+            "duration": video_info['duration'],
+            "upload_date": video_info['upload_date'],
+            "url": video_info['url'],
+            "thumbnail": f"https://i.ytimg.com/vi/{video_info['id']}/maxresdefault.jpg"
+        },
+        "processing_info": {
+            "processed_at": datetime.now().isoformat(),
+            "status": "article_completed",
+            "lambda_function": "generate_article",
+            "transcript_key": transcript_key,
+            "article_key": article_key,
+            "generation": generation_stats,
+            "cache": cache_info,
+            "normalization": normalization_info,
+            "file_sizes": {
+                "transcript_length": len(full_content),
+                "article_length": len(html_content)
+            }
+        },
+        "system_info": {
+            "python_version": "3.11",
+            "openai_model_gpt": ARTICLE_MODEL
+        }
+    }
+    
+    metadata_key = f"metadata/article_{video_info['id']}_{timestamp}.json"
+    s3.put_object(
+        Bucket=bucket,
+        Key=metadata_key,
+        Body=json.dumps(metadata, ensure_ascii=False, indent=2).encode('utf-8'),
+        ContentType='application/json'
+    )
+    
+    return metadata_key
+
 def parse_transcript_content(content):
     """文字起こしファイルの内容を解析して情報を抽出"""
     try:
@@ -172,18 +273,8 @@ def parse_transcript_content(content):
         print(f"❌ 文字起こしファイル解析エラー: {str(e)}")
         return None, None, None
 
-def generate_article(video_info, transcript_text):
-    """文字起こしから記事を生成"""
-    print("📄 記事生成中...")
-    
-    # OpenAI 0.28.0 安定版での初期化
-    try:
-        openai.api_key = os.environ['OPENAI_API_KEY']
-        print(f"✅ OpenAI初期化成功 (バージョン: {openai.__version__})")
-    except Exception as e:
-        print(f"❌ OpenAI初期化エラー: {str(e)}")
-        raise
-    
+def build_article_messages(video_info, transcript_text):
+    """記事生成用のChatCompletionメッセージを組み立て"""
     prompt = f"""
 以下のYouTube動画の文字起こしから、SEO最適化されたブログ記事を作成してください。
 
@@ -205,34 +296,226 @@ def generate_article(video_info, transcript_text):
 8. 不要な要素（CSS、JavaScript、メタ情報等）は含めない
 """
     
+    return [
+        {"role": "system", "content": "あなたは医療・健康分野に精通したプロのブログライターです。正確で分かりやすい記事を作成します。"},
+        {"role": "user", "content": prompt}
+    ]
+
+def normalize_transcript_for_cache(transcript_text):
+    """キャッシュキー用に文字起こしを正規化（Unicode正規化・空白の統一）"""
+    text = unicodedata.normalize('NFKC', transcript_text)
+    return ' '.join(text.split())
+
+def article_cache_key(video_info, transcript_text):
+    """文字起こし・プロンプト版数・モデル・サンプリング設定から記事キャッシュキーを生成
+    
+    プロンプトに埋め込まれる動画情報（タイトル・URL・投稿者）も含める。
+    """
+    payload = json.dumps({
+        "transcript": normalize_transcript_for_cache(transcript_text),
+        "video": [video_info.get('title'), video_info.get('url'), video_info.get('uploader')],
+        "prompt_version": ARTICLE_PROMPT_VERSION,
+        "model": ARTICLE_MODEL,
+        "max_tokens": ARTICLE_MAX_TOKENS,
+        "temperature": ARTICLE_TEMPERATURE
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def load_cached_article(bucket, cache_key):
+    """S3のキャッシュから記事HTMLを取得（なければNone）"""
+    try:
+        response = s3.get_object(Bucket=bucket, Key=f"{ARTICLE_CACHE_PREFIX}{cache_key}.html")
+        return response['Body'].read().decode('utf-8')
+    except s3.exceptions.NoSuchKey:
+        return None
+    except Exception as e:
+        print(f"⚠️ 記事キャッシュの読み込みに失敗: {e}")
+        return None
+
+def store_cached_article(bucket, cache_key, html_content):
+    """生成した記事HTMLをS3のキャッシュに保存"""
+    try:
+        s3.put_object(
+            Bucket=bucket,
+            Key=f"{ARTICLE_CACHE_PREFIX}{cache_key}.html",
+            Body=html_content.encode('utf-8'),
+            ContentType='text/html'
+        )
+    except Exception as e:
+        print(f"⚠️ 記事キャッシュの保存に失敗: {e}")
+
+def strip_code_fences(article):
+    """Markdownのコードブロック記号を除去"""
+    if article.startswith('```html'):
+        article = article[7:]  # '```html' を除去
+    elif article.startswith('```'):
+        article = article[3:]   # '```' を除去
+    
+    if article.endswith('```'):
+        article = article[:-3]  # 末尾の '```' を除去
+    
+    return article.strip()  # 前後の空白を除去
+
+class CodeFenceStripper:
+    """ストリーミング出力からコードブロック記号を逐次除去
+    
+    先頭は7文字（'```html'）揃うまで保留し、末尾の '```' に備えて
+    常に最後の3文字を保留する。結果は strip_code_fences と一致する。
+    """
+    
+    def __init__(self):
+        self._head = ''
+        self._head_done = False
+        self._leading = True
+        self._tail = ''
+    
+    def feed(self, text):
+        """トークンを受け取り、確定した部分を返す"""
+        if not self._head_done:
+            self._head += text
+            if len(self._head) < 7:
+                return ''
+            text = self._strip_head()
+        return self._emit(text)
+    
+    def finish(self):
+        """ストリーム終了時に残りを返す"""
+        text = ''
+        if not self._head_done:
+            text = self._strip_head()
+        tail = self._tail + text
+        self._tail = ''
+        if tail.endswith('```'):
+            tail = tail[:-3]
+        if self._leading:
+            tail = tail.lstrip()
+        return tail
+    
+    def _strip_head(self):
+        self._head_done = True
+        head = self._head
+        if head.startswith('```html'):
+            head = head[7:]
+        elif head.startswith('```'):
+            head = head[3:]
+        return head
+    
+    def _emit(self, text):
+        if self._leading:
+            text = text.lstrip()
+            if not text:
+                return ''
+            self._leading = False
+        buffered = self._tail + text
+        self._tail = buffered[-3:]
+        return buffered[:-3]
+
+def generate_article(video_info, transcript_text):
+    """文字起こしから記事を生成"""
+    print("📄 記事生成中...")
+    
+    # OpenAI 0.28.0 安定版での初期化
+    try:
+        openai.api_key = os.environ['OPENAI_API_KEY']
+        print(f"✅ OpenAI初期化成功 (バージョン: {openai.__version__})")
+    except Exception as e:
+        print(f"❌ OpenAI初期化エラー: {str(e)}")
+        raise
+    
     try:
         # OpenAI 0.28.0 旧API形式（安定版）
-        response = openai.ChatCompletion.create(
-            model="gpt-4-turbo",
-            messages=[
-                {"role": "system", "content": "あなたは医療・健康分野に精通したプロのブログライターです。正確で分かりやすい記事を作成します。"},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=3000,
-            temperature=0.7
+        # 生成は副作用がないため、遅延時はヘッジリクエストで先に返った方を採用
+        response = hedged_call(
+            'openai.chat_completion',
+            openai.ChatCompletion.create,
+            model=ARTICLE_MODEL,
+            messages=build_article_messages(video_info, transcript_text),
+            max_tokens=ARTICLE_MAX_TOKENS,
+            temperature=ARTICLE_TEMPERATURE
         )
         
-        article = response.choices[0].message.content
+        article = strip_code_fences(response.choices[0].message.content)
         
-        # Markdownのコードブロック記号を除去
-        if article.startswith('```html'):
-            article = article[7:]  # '```html' を除去
-        elif article.startswith('```'):
-            article = article[3:]   # '```' を除去
+        print(f"✅ 記事生成完了 ({len(article)}文字)")
+        return article
+        
+    except Exception as e:
+        print(f"❌ 記事生成エラー: {str(e)}")
+        return None
+
+def generate_article_stream(video_info, transcript_text, flush_callback=None):
+    """文字起こしから記事をストリーミング生成
+    
+    トークン到着ごとにコードブロック記号を除去し、STREAM_FLUSH_INTERVAL秒ごとに
+    flush_callbackへ途中経過を渡す。失敗時も途中経過を最後に一度保存する。
+    
+    Returns:
+        (記事HTML または None, 生成統計dict)
+    """
+    print("📄 記事生成中（ストリーミング）...")
+    
+    # OpenAI 0.28.0 安定版での初期化
+    try:
+        openai.api_key = os.environ['OPENAI_API_KEY']
+        print(f"✅ OpenAI初期化成功 (バージョン: {openai.__version__})")
+    except Exception as e:
+        print(f"❌ OpenAI初期化エラー: {str(e)}")
+        raise
+    
+    stats = {
+        "mode": "stream",
+        "time_to_first_token_sec": None,
+        "total_generation_sec": None,
+        "partial_flushes": 0
+    }
+    stripper = CodeFenceStripper()
+    parts = []
+    started = time.monotonic()
+    last_flush = started
+    
+    def flush():
+        if flush_callback and parts:
+            try:
+                flush_callback(''.join(parts))
+                stats['partial_flushes'] += 1
+            except Exception as e:
+                print(f"⚠️ 途中経過の保存に失敗: {e}")
+    
+    try:
+        # OpenAI 0.28.0 旧API形式（安定版）
+        response = openai.ChatCompletion.create(
+            model=ARTICLE_MODEL,
+            messages=build_article_messages(video_info, transcript_text),
+            max_tokens=ARTICLE_MAX_TOKENS,
+            temperature=ARTICLE_TEMPERATURE,
+            stream=True
+        )
         
-        if article.endswith('```'):
-            article = article[:-3]  # 末尾の '```' を除去
+        for chunk in response:
+            token = chunk['choices'][0]['delta'].get('content')
+            if not token:
+                continue
+            
+            now = time.monotonic()
+            if stats['time_to_first_token_sec'] is None:
+                stats['time_to_first_token_sec'] = round(now - started, 3)
+                print(f"⏱️ 最初のトークン受信: {stats['time_to_first_token_sec']}秒")
+            
+            parts.append(stripper.feed(token))
+            
+            if now - last_flush >= STREAM_FLUSH_INTERVAL:
+                flush()
+                last_flush = now
         
-        article = article.strip()  # 前後の空白を除去
+        parts.append(stripper.finish())
+        article = ''.join(parts).strip()
+        stats['total_generation_sec'] = round(time.monotonic() - started, 3)
         
-        print(f"✅ 記事生成完了 ({len(article)}文字)")
-        return article
+        print(f"✅ 記事生成完了 ({len(article)}文字, {stats['total_generation_sec']}秒)")
+        return article, stats
         
     except Exception as e:
         print(f"❌ 記事生成エラー: {str(e)}")
-        return None
\ No newline at end of file
+        stats['total_generation_sec'] = round(time.monotonic() - started, 3)
+        flush()
+        return None, stats
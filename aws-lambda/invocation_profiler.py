@@ -0,0 +1,246 @@
+import boto3
+import functools
+import html
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+from collections import Counter
+from datetime import datetime
+
+# AWS clients
+s3 = boto3.client('s3')
+
+# プロファイリング（環境変数またはイベントの "profile": true で有効化）
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', '').lower() in ('1', 'true', 'yes')
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', '10'))
+PROFILE_PREFIX = 'profiles/'
+
+# フレームグラフの描画設定
+FLAMEGRAPH_WIDTH = 1200
+FLAMEGRAPH_ROW_HEIGHT = 16
+
+class SamplingProfiler:
+    """別スレッドから一定間隔でスタックを採取するサンプリングプロファイラ
+    
+    sys._current_frames() を読むだけなので計測対象のコードには手を入れず、
+    オーバーヘッドはサンプリング間隔に比例して小さく抑えられる。
+    """
+    
+    def __init__(self, interval_ms=PROFILE_INTERVAL_MS):
+        self.interval = interval_ms / 1000
+        self.samples = Counter()
+        self.sample_count = 0
+        self._target_thread = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+    
+    def start(self):
+        self.started = time.monotonic()
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.elapsed = time.monotonic() - self.started
+    
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = self._collapse(frame)
+                # ハンドラ以外の待機中スレッド（スレッドプール等）はノイズになるので除外
+                if ident != self._target_thread and stack[-1].startswith('wait ('):
+                    continue
+                self.samples[(names.get(ident, str(ident)),) + stack] += 1
+            self.sample_count += 1
+    
+    @staticmethod
+    def _collapse(frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return tuple(reversed(stack))
+    
+    def folded(self):
+        """flamegraph.pl / speedscope 互換の collapsed stack 形式"""
+        return '\n'.join(
+            f"{';'.join(stack)} {count}" for stack, count in self.samples.most_common()
+        ) + '\n'
+    
+    def flamegraph_svg(self, title):
+        """採取したスタックから簡易フレームグラフ（SVG）を生成"""
+        tree = {'children': {}, 'count': 0}
+        for stack, count in self.samples.items():
+            node = tree
+            node['count'] += count
+            for name in stack:
+                node = node['children'].setdefault(name, {'children': {}, 'count': 0})
+                node['count'] += count
+        
+        total = max(tree['count'], 1)
+        frames = []
+        
+        def walk(node, name, x, depth):
+            width = node['count'] / total * FLAMEGRAPH_WIDTH
+            if width < 0.5:
+                return
+            frames.append((name, node['count'], x, depth, width))
+            child_x = x
+            for child_name, child in sorted(node['children'].items()):
+                walk(child, child_name, child_x, depth + 1)
+                child_x += child['count'] / total * FLAMEGRAPH_WIDTH
+        
+        walk(tree, 'all', 0, 0)
+        
+        # 根を下に描く（通常のフレームグラフと同じ向き）
+        rows = max((depth for _, _, _, depth, _ in frames), default=0) + 1
+        height = rows * FLAMEGRAPH_ROW_HEIGHT + 30
+        rects = []
+        for name, count, x, depth, width in frames:
+            y = height - (depth + 1) * FLAMEGRAPH_ROW_HEIGHT
+            hue = 20 + zlib.crc32(name.encode('utf-8')) % 40
+            label = html.escape(name)
+            rects.append(
+                f'<g><title>{label} ({count} samples, {count / total * 100:.1f}%)</title>'
+                f'<rect x="{x:.1f}" y="{y}" width="{width:.1f}" height="{FLAMEGRAPH_ROW_HEIGHT - 1}" '
+                f'fill="hsl({hue},80%,60%)"/>'
+                f'<text x="{x + 2:.1f}" y="{y + FLAMEGRAPH_ROW_HEIGHT - 4}" font-size="11" '
+                f'font-family="monospace">{html.escape(name[:int(width / 7)])}</text></g>'
+            )
+        
+        return (
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{FLAMEGRAPH_WIDTH}" height="{height}">\n'
+            f'<text x="4" y="16" font-size="13" font-family="sans-serif">{html.escape(title)}</text>\n'
+            + '\n'.join(rects)
+            + '\n</svg>\n'
+        )
+
+def _event_fields(event):
+    """イベント本体（API Gatewayの場合はJSON文字列のbody）を辞書で返す"""
+    if not isinstance(event, dict):
+        return {}
+    if isinstance(event.get('body'), str):
+        try:
+            parsed = json.loads(event['body'])
+        except (TypeError, ValueError):
+            parsed = None
+        # 配列・null・数値などのbodyはイベント本体のみを使う
+        if isinstance(parsed, dict):
+            return {**event, **parsed}
+    return event
+
+def _event_bucket(event):
+    """イベントから成果物と同じS3バケットを特定"""
+    fields = _event_fields(event)
+    if 'Records' in fields:
+        return fields['Records'][0]['s3']['bucket']['name']
+    return fields.get('bucket') or os.environ.get('S3_BUCKET')
+
+def _result_field(result, key):
+    """ハンドラの戻り値（JSON文字列のbody）から項目を取得（なければNone）"""
+    try:
+        body = json.loads(result['body'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return body.get(key) if isinstance(body, dict) else None
+
+def _wants_profile(event):
+    return bool(_event_fields(event).get('profile')) or PROFILING_ENABLED
+
+def profile_handler(name):
+    """lambda_handler をサンプリングプロファイラで包むデコレータ
+    
+    有効時は collapsed stack とフレームグラフSVGを profiles/ に保存する。
+    ハンドラが metadata_key を返した場合はメタデータと同じ名前で保存し、
+    そのメタデータの processing_info.profile にも保存先を記録する。
+    無効時のオーバーヘッドは判定1回のみ。
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            if not _wants_profile(event):
+                return handler(event, context)
+            
+            profiler = SamplingProfiler()
+            profiler.start()
+            result = None
+            try:
+                result = handler(event, context)
+                return result
+            finally:
+                profiler.stop()
+                _upload_profile(name, profiler, event, context, result)
+        return wrapper
+    return decorator
+
+def _upload_profile(name, profiler, event, context, result=None):
+    """プロファイル結果をS3に保存（失敗しても本処理には影響させない）
+    
+    保存先は metadata/<処理>_<ID>_<timestamp>.json に対応する
+    profiles/<処理>_<ID>_<timestamp>_<request_id>.svg（メタデータがない場合は動画IDと実行時刻）。
+    """
+    try:
+        bucket = _event_bucket(event)
+        if not bucket:
+            print("⚠️ プロファイル保存先のバケットが特定できません")
+            return
+        
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        request_id = getattr(context, 'aws_request_id', 'local')
+        metadata_key = _result_field(result, 'metadata_key')
+        video_id = _result_field(result, 'video_id')
+        if metadata_key:
+            base_key = f"{PROFILE_PREFIX}{os.path.splitext(os.path.basename(metadata_key))[0]}_{request_id}"
+        elif video_id:
+            base_key = f"{PROFILE_PREFIX}{name}_{video_id}_{timestamp}_{request_id}"
+        else:
+            base_key = f"{PROFILE_PREFIX}{name}_{timestamp}_{request_id}"
+        title = f"{name} {timestamp} ({profiler.sample_count} samples, {profiler.elapsed:.1f}s)"
+        
+        s3.put_object(
+            Bucket=bucket,
+            Key=f"{base_key}.folded",
+            Body=profiler.folded().encode('utf-8'),
+            ContentType='text/plain'
+        )
+        s3.put_object(
+            Bucket=bucket,
+            Key=f"{base_key}.svg",
+            Body=profiler.flamegraph_svg(title).encode('utf-8'),
+            ContentType='image/svg+xml'
+        )
+        print(f"📈 プロファイルを保存: s3://{bucket}/{base_key}.svg ({profiler.sample_count}サンプル)")
+        
+        if metadata_key:
+            _record_profile(bucket, metadata_key, {
+                "svg_key": f"{base_key}.svg",
+                "folded_key": f"{base_key}.folded",
+                "samples": profiler.sample_count,
+                "elapsed_sec": round(profiler.elapsed, 3),
+                "request_id": request_id
+            })
+    
+    except Exception as e:
+        print(f"⚠️ プロファイルの保存に失敗: {e}")
+
+def _record_profile(bucket, metadata_key, profile):
+    """ジョブのメタデータに processing_info.profile としてプロファイルの保存先を追記"""
+    response = s3.get_object(Bucket=bucket, Key=metadata_key)
+    metadata = json.loads(response['Body'].read().decode('utf-8'))
+    metadata.setdefault('processing_info', {})['profile'] = profile
+    s3.put_object(
+        Bucket=bucket,
+        Key=metadata_key,
+        Body=json.dumps(metadata, ensure_ascii=False, indent=2).encode('utf-8'),
+        ContentType='application/json'
+    )
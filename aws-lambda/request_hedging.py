@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# ヘッジリクエスト（opt-in）
+HEDGING_ENABLED = os.environ.get('HEDGING_ENABLED', '').lower() in ('1', 'true', 'yes')
+# この分位点のレイテンシを超えても応答がなければ2本目を送る
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', '95'))
+# 分位点を信用するまでに必要なサンプル数
+HEDGE_MIN_SAMPLES = int(os.environ.get('HEDGE_MIN_SAMPLES', '20'))
+# 追加リクエストの上限（全リクエスト数に対する比率）
+HEDGE_BUDGET_RATIO = float(os.environ.get('HEDGE_BUDGET_RATIO', '0.1'))
+# 操作ごとに保持するレイテンシの件数
+HEDGE_WINDOW_SIZE = 200
+
+class LatencyHistogram:
+    """直近のレイテンシを保持するローリングウィンドウ"""
+    
+    def __init__(self, size=HEDGE_WINDOW_SIZE):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+    
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+    
+    def percentile(self, pct):
+        """分位点（サンプル不足ならNone）"""
+        with self._lock:
+            if len(self._samples) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(len(ordered) * pct / 100))
+        return ordered[index]
+
+# プロセス内で共有（ウォームスタート間で引き継がれる）
+_histograms = {}
+_stats = {'requests': 0, 'hedges_fired': 0, 'hedges_won': 0}
+_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='hedge')
+
+def _histogram(name):
+    with _lock:
+        if name not in _histograms:
+            _histograms[name] = LatencyHistogram()
+        return _histograms[name]
+
+def _take_budget():
+    """予算内なら追加リクエスト1本分を確保"""
+    with _lock:
+        if _stats['hedges_fired'] + 1 > _stats['requests'] * HEDGE_BUDGET_RATIO:
+            return False
+        _stats['hedges_fired'] += 1
+        return True
+
+def _count(key):
+    with _lock:
+        _stats[key] += 1
+
+def hedge_stats():
+    """ヘッジの発火数・勝利数などのカウンタ"""
+    with _lock:
+        return dict(_stats)
+
+def hedged_call(name, fn, *args, **kwargs):
+    """応答が遅い場合に同じ呼び出しをもう1本送り、先に成功した方を返す
+    
+    2本とも実行されうるため、重複しても副作用のない呼び出し（読み取り・記事生成など）にのみ使う。
+    負けた側の結果は捨てる。HEDGING_ENABLED が無効なら fn をそのまま呼ぶ。
+    """
+    if not HEDGING_ENABLED:
+        return fn(*args, **kwargs)
+    
+    histogram = _histogram(name)
+    _count('requests')
+    
+    def timed():
+        started = time.monotonic()
+        result = fn(*args, **kwargs)
+        histogram.record(time.monotonic() - started)
+        return result
+    
+    primary = _executor.submit(timed)
+    delay = histogram.percentile(HEDGE_PERCENTILE)
+    if delay is None:
+        return primary.result()
+    
+    done, _ = wait([primary], timeout=delay)
+    if done or not _take_budget():
+        return primary.result()
+    
+    print(f"🪁 {name}: {delay:.2f}秒応答がないためヘッジリクエストを送信")
+    hedge = _executor.submit(timed)
+    pending = {primary, hedge}
+    error = None
+    
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is not None:
+                error = future.exception()
+                continue
+            
+            if future is hedge:
+                _count('hedges_won')
+            return future.result()
+    
+    raise error
@@ -0,0 +1,37 @@
+"""transcript_normalizer の回帰テスト（python -m pytest test_transcript_normalizer.py）"""
+import pytest
+
+from transcript_normalizer import normalize_transcript
+
+@pytest.mark.parametrize('text', [
+    '費用は100000000円です。',
+    '０１２０－００００－００００までお電話ください。',
+    '0120-0000-0000',
+    '1234123412341234',
+    '１２３４１２３４１２３４',
+    '用量は5mg5mg5mgです。',
+    '詳しくは https://example.com/aaaa/aaaa をご覧ください。',
+    'https://example.com/wwwww',
+    'あの人はまあまあ元気です。',
+    'いろいろ試して、どんどん良くなりました。',
+    'あーいう風に言われました。',
+    'あーーゆうことです。',
+    'あーしてこうして、完成です。',
+])
+def test_literals_are_preserved(text):
+    assert normalize_transcript(text)[0] == text.strip()
+
+@pytest.mark.parametrize('text, expected', [
+    ('えーと、今日はですね、あの、血圧についてお話しします。', '今日はですね、血圧についてお話しします。'),
+    ('そうですねそうですね、そうですね。', 'そうですね。'),
+    ('ご視聴ありがとうございました。ご視聴ありがとうございました。', 'ご視聴ありがとうございました。'),
+    ('ははははははは。', 'は。'),
+    ('まあ、うーん、薬を飲むことが大事です。', '薬を飲むことが大事です。'),
+])
+def test_fillers_and_repeats_are_removed(text, expected):
+    assert normalize_transcript(text)[0] == expected
+
+def test_stats_report_token_reduction():
+    _, stats = normalize_transcript('えーと、そうですねそうですね。')
+    assert stats['tokens_after'] < stats['tokens_before']
+    assert stats['token_reduction'] == stats['tokens_before'] - stats['tokens_after']
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import boto3
+import os
+import subprocess
+import wave
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from extract_transcript_lambda import FFMPEG_PATH
+
+# AWS clients
+s3 = boto3.client('s3')
+
+# チャンク単位の文字起こしキャッシュ（再アップロード時は変更のあったチャンクのみWhisperへ送る）
+CHUNK_CACHE_PREFIX = 'cache/transcripts/'
+CHUNK_CACHE_VERSION = 'v1'
+CHUNK_SAMPLE_RATE = 16000
+
+# チャンクは無音位置で区切る。境界は前後 CHUNK_MIN_SECONDS の範囲で最も長い無音とし、
+# ファイル先頭からの位置に依存しない（先頭をカットしても同じ境界に揃う）
+CHUNK_MIN_SECONDS = int(os.environ.get('TRANSCRIPT_CHUNK_MIN_SECONDS', '60'))
+CHUNK_MAX_SECONDS = int(os.environ.get('TRANSCRIPT_CHUNK_MAX_SECONDS', '180'))
+# 無音とみなす振幅（int16, 既定328 ≈ -40dBFS）と、境界候補にする無音の最短長
+SILENCE_LEVEL = int(os.environ.get('TRANSCRIPT_SILENCE_LEVEL', '328'))
+MIN_SILENCE_SAMPLES = CHUNK_SAMPLE_RATE * 3 // 10
+
+# 同時に処理するチャンク数（キャッシュ参照・文字起こし）
+CHUNK_CACHE_WORKERS = int(os.environ.get('TRANSCRIPT_CHUNK_WORKERS', '4'))
+
+def decode_pcm(audio_path):
+    """FFmpegで音声を16kHzモノラルのint16 PCMにデコード"""
+    cmd = [
+        FFMPEG_PATH, '-v', 'quiet', '-i', audio_path,
+        '-ac', '1', '-ar', str(CHUNK_SAMPLE_RATE),
+        '-f', 's16le', '-'
+    ]
+    result = subprocess.run(cmd, capture_output=True, timeout=900)
+    if result.returncode != 0:
+        raise Exception("チャンク用の音声デコードに失敗しました")
+    return np.frombuffer(result.stdout, dtype=np.int16)
+
+def silence_runs(pcm, min_samples=MIN_SILENCE_SAMPLES):
+    """振幅が SILENCE_LEVEL 未満のサンプルが min_samples 以上続く区間
+    
+    サンプル単位で求めるため、先頭からの位置がずれても各区間の長さは変わらない。
+    
+    Returns:
+        (開始サンプルの配列, 終了サンプルの配列)
+    """
+    # abs() は -32768 で溢れるため上下の閾値で判定
+    quiet = (pcm < SILENCE_LEVEL) & (pcm > -SILENCE_LEVEL)
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], quiet, [False])).astype(np.int8)))
+    starts, ends = edges[0::2], edges[1::2]
+    keep = (ends - starts) >= min_samples
+    return starts[keep], ends[keep]
+
+def split_chunks(pcm):
+    """内容から決まる無音位置でPCMを分割
+    
+    前後 CHUNK_MIN_SECONDS 以内に自分より長い無音がない無音区間の中央を境界にする
+    （同じ長さなら前にある方を優先）。判定は周囲の内容だけで決まるため、
+    冒頭のカットや途中の差し替えがあっても、その付近以外の境界は変わらない。
+    CHUNK_MAX_SECONDS を超える区間は、その中で最も長い無音で再帰的に分割する。
+    
+    Returns:
+        [(開始サンプル, 終了サンプル), ...]
+    """
+    starts, ends = silence_runs(pcm)
+    lengths = ends - starts
+    centers = (starts + ends) // 2
+    window = CHUNK_MIN_SECONDS * CHUNK_SAMPLE_RATE
+    max_samples = CHUNK_MAX_SECONDS * CHUNK_SAMPLE_RATE
+    
+    boundaries = []
+    for i in range(len(centers)):
+        lo = np.searchsorted(centers, centers[i] - window)
+        hi = np.searchsorted(centers, centers[i] + window, side='right')
+        if lengths[i] < lengths[lo:hi].max():
+            continue
+        # 同じ長さの無音は前にある方を境界にする
+        if np.any(lengths[lo:i] == lengths[i]):
+            continue
+        boundaries.append(int(centers[i]))
+    
+    def split_long(start, end):
+        """長すぎる区間を最も長い無音（なければ固定長）で分割"""
+        if end - start <= max_samples:
+            return [start]
+        inner = np.flatnonzero((centers > start) & (centers < end))
+        if len(inner):
+            cut = int(centers[inner[np.argmax(lengths[inner])]])
+        else:
+            cut = start + max_samples
+        return split_long(start, cut) + split_long(cut, end)
+    
+    points = [0] + boundaries + [len(pcm)]
+    cuts = []
+    for start, end in zip(points[:-1], points[1:]):
+        if end > start:
+            cuts.extend(split_long(start, end))
+    cuts.append(len(pcm))
+    return list(zip(cuts[:-1], cuts[1:]))
+
+def trim_silence(samples):
+    """前後の無音を除いた範囲 (先頭, 末尾) を返す（全て無音ならNone）
+    
+    境界は無音区間の中にあるため、除去後の内容は境界の位置に左右されない。
+    """
+    loud = np.flatnonzero((samples >= SILENCE_LEVEL) | (samples <= -SILENCE_LEVEL))
+    if len(loud) == 0:
+        return None
+    return int(loud[0]), int(loud[-1]) + 1
+
+def chunk_cache_key(samples, backend, language):
+    """デコード済みPCMの内容・モデル・言語からキャッシュキーを生成"""
+    digest = hashlib.sha256(samples.tobytes())
+    digest.update(f"|{CHUNK_CACHE_VERSION}|{backend.name}|{backend.model}|{language}".encode('utf-8'))
+    return digest.hexdigest()
+
+def load_cached_chunk(bucket, cache_key):
+    """S3のキャッシュからチャンクの文字起こし結果を取得（なければNone）"""
+    try:
+        response = s3.get_object(Bucket=bucket, Key=f"{CHUNK_CACHE_PREFIX}{cache_key}.json")
+        return json.loads(response['Body'].read().decode('utf-8'))
+    except s3.exceptions.NoSuchKey:
+        return None
+    except Exception as e:
+        print(f"⚠️ チャンクキャッシュの読み込みに失敗: {e}")
+        return None
+
+def store_cached_chunk(bucket, cache_key, result):
+    """チャンクの文字起こし結果をS3のキャッシュに保存"""
+    try:
+        s3.put_object(
+            Bucket=bucket,
+            Key=f"{CHUNK_CACHE_PREFIX}{cache_key}.json",
+            Body=json.dumps(result, ensure_ascii=False).encode('utf-8'),
+            ContentType='application/json'
+        )
+    except Exception as e:
+        print(f"⚠️ チャンクキャッシュの保存に失敗: {e}")
+
+def write_wav(path, samples):
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(CHUNK_SAMPLE_RATE)
+        f.writeframes(samples.tobytes())
+
+def transcribe_with_chunk_cache(bucket, audio_path, work_dir, backend, language='ja'):
+    """チャンクごとにキャッシュを参照し、未キャッシュのチャンクだけを文字起こし
+    
+    キャッシュのセグメント時刻は無音除去後のチャンク先頭からの相対値で保存し、
+    今回のチャンク位置に合わせて補正してから連結する。
+    
+    Returns:
+        (文字起こしテキスト, 全体の時刻に補正したセグメント, 再利用率などの統計情報)
+    """
+    pcm = decode_pcm(audio_path)
+    chunks = split_chunks(pcm)
+    print(f"🧩 チャンク分割: {len(chunks)}チャンク ({len(pcm) / CHUNK_SAMPLE_RATE:.0f}秒)")
+    
+    def process_chunk(index, start, end):
+        trimmed = trim_silence(pcm[start:end])
+        if trimmed is None:
+            return {'text': '', 'segments': [], 'seconds': 0.0, 'reused': False}
+        
+        offset = start + trimmed[0]
+        samples = pcm[offset:start + trimmed[1]]
+        seconds = len(samples) / CHUNK_SAMPLE_RATE
+        cache_key = chunk_cache_key(samples, backend, language)
+        
+        cached = load_cached_chunk(bucket, cache_key)
+        reused = cached is not None
+        if not reused:
+            chunk_path = os.path.join(work_dir, f"chunk_{index:04d}.wav")
+            write_wav(chunk_path, samples)
+            try:
+                result = backend.transcribe(chunk_path, language=language)
+            finally:
+                os.remove(chunk_path)
+            cached = {'text': result['text'], 'segments': result['segments']}
+            store_cached_chunk(bucket, cache_key, cached)
+        
+        shift = offset / CHUNK_SAMPLE_RATE
+        segments = [
+            dict(seg, start=seg['start'] + shift, end=seg['end'] + shift)
+            for seg in cached['segments']
+        ]
+        return {'text': cached['text'], 'segments': segments, 'seconds': seconds, 'reused': reused}
+    
+    with ThreadPoolExecutor(max_workers=CHUNK_CACHE_WORKERS) as pool:
+        results = list(pool.map(process_chunk, range(len(chunks)), *zip(*chunks)))
+    
+    audio_seconds = sum(r['seconds'] for r in results)
+    reused_seconds = sum(r['seconds'] for r in results if r['reused'])
+    stats = {
+        'chunks': len(results),
+        'reused_chunks': sum(1 for r in results if r['reused']),
+        'audio_seconds': round(audio_seconds, 3),
+        'reused_seconds': round(reused_seconds, 3),
+        'reuse_ratio': round(reused_seconds / audio_seconds, 4) if audio_seconds else 0.0
+    }
+    print(f"♻️ チャンクキャッシュ: {stats['reused_chunks']}/{stats['chunks']}チャンクを再利用 (再利用率 {stats['reuse_ratio']:.1%})")
+    
+    segments = [seg for r in results for seg in r['segments']]
+    return ''.join(r['text'] for r in results), segments, stats
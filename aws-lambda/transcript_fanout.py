@@ -0,0 +1,394 @@
+import json
+import boto3
+import os
+import subprocess
+import tempfile
+from botocore.exceptions import ClientError
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from extract_transcript_lambda import (
+    FFMPEG_PATH,
+    format_transcript_content,
+    presigned_source_url,
+    probe_media,
+    save_transcript_outputs,
+    transcribe_audio_text,
+)
+from transcription_backends import select_backend
+
+# AWS clients
+s3 = boto3.client('s3')
+lambda_client = boto3.client('lambda')
+
+# この長さ（秒）を超える動画は分割処理する（0で無効）
+FANOUT_THRESHOLD_SECONDS = int(os.environ.get('FANOUT_THRESHOLD_SECONDS', '0'))
+# 1ワーカーが担当する時間範囲（秒）
+FANOUT_SEGMENT_SECONDS = int(os.environ.get('FANOUT_SEGMENT_SECONDS', '900'))
+# ワーカーの呼び出し先（未設定なら自分自身）
+FANOUT_WORKER_FUNCTION = os.environ.get('FANOUT_WORKER_FUNCTION', '')
+# 1パートの試行回数の上限（Lambda非同期呼び出しの既定: 初回 + 再試行2回）。
+# この回数失敗したらジョブを失敗としてメタデータに記録する
+FANOUT_PART_MAX_ATTEMPTS = int(os.environ.get('FANOUT_PART_MAX_ATTEMPTS', '3'))
+JOB_PREFIX = 'jobs/'
+
+def handle_fanout_event(event, context):
+    """extract_transcript_lambda から委譲される分割ジョブのイベントを処理
+    
+    - fanout_action=part: 1つの時間範囲を抽出・文字起こし
+    - fanout_action=join: 全パートを結合して文字起こしファイルを作成
+    
+    パートの失敗は例外のまま送出し、非同期呼び出しの再試行・DLQに任せる
+    （値を返すとLambdaは成功とみなし、再試行しない）。
+    """
+    
+    action = event.get('fanout_action')
+    try:
+        bucket = event['bucket']
+        job_id = event['job_id']
+        
+        if action == 'part':
+            try:
+                result = process_part(bucket, job_id, event['index'])
+            except Exception as e:
+                handle_part_failure(bucket, job_id, event['index'], e)
+                raise
+            # 最後に終わったパートが結合を担当。同時に全パートが揃って見えても、
+            # 結合マーカーを作成できた1つだけが結合する
+            if result['parts_done'] == result['parts_total'] and claim_join(bucket, job_id, f"part_{event['index']:04d}"):
+                result = join_claimed_parts(bucket, job_id)
+        elif action == 'join':
+            if not claim_join(bucket, job_id, 'join'):
+                raise Exception(f"分割ジョブは既に結合済みまたは結合中です: {job_id}")
+            result = join_claimed_parts(bucket, job_id)
+        else:
+            raise ValueError(f"unknown fanout_action: {action}")
+        
+        return {
+            'statusCode': 200,
+            'body': json.dumps(result, ensure_ascii=False)
+        }
+    
+    except Exception as e:
+        print(f"❌ エラー: {str(e)}")
+        if action == 'part':
+            raise
+        return {
+            'statusCode': 500,
+            'body': json.dumps({
+                'error': str(e)
+            }, ensure_ascii=False)
+        }
+
+def plan_segments(duration, segment_seconds):
+    """動画全体を時間範囲のリストに分割"""
+    segments = []
+    start = 0.0
+    while start < duration:
+        length = min(segment_seconds, duration - start)
+        segments.append({'index': len(segments), 'start': start, 'duration': length})
+        start += segment_seconds
+    return segments
+
+def start_fanout_job(bucket, video_key, youtube_url, video_id, timestamp, context, dispatch=True, probe=None):
+    """長尺動画を時間範囲ごとのワーカーに分割（対象外ならNone）
+    
+    ダウンロード前にpresigned URL経由でFFprobeし（事前検証の結果があれば再利用）、
+    長さが閾値を超える場合のみマニフェストを jobs/ に保存してワーカーを非同期起動する。
+    """
+    if FANOUT_THRESHOLD_SECONDS <= 0 and dispatch:
+        return None
+    
+    if probe is None:
+        probe = probe_media(presigned_source_url(bucket, video_key))
+    if not probe or not probe['duration'] or not probe['audio_codec']:
+        print("⚠️ 事前解析に失敗したため通常処理で続行します")
+        return None
+    
+    duration = probe['duration']
+    if dispatch and duration <= FANOUT_THRESHOLD_SECONDS:
+        return None
+    
+    job_id = f"{video_id}_{timestamp}"
+    segments = plan_segments(duration, FANOUT_SEGMENT_SECONDS)
+    manifest = {
+        "job_id": job_id,
+        "video_key": video_key,
+        "video_info": {
+            'id': video_id,
+            'title': f"動画 ({os.path.basename(video_key)})",
+            'uploader': '不明',
+            'duration': int(duration),
+            'upload_date': datetime.now().strftime('%Y%m%d'),
+            'url': youtube_url
+        },
+        "timestamp": timestamp,
+        "created_at": datetime.now().isoformat(),
+        "segments": segments
+    }
+    s3.put_object(
+        Bucket=bucket,
+        Key=f"{JOB_PREFIX}{job_id}/manifest.json",
+        Body=json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8'),
+        ContentType='application/json'
+    )
+    print(f"🧩 分割ジョブ作成: {job_id} ({duration:.0f}秒 → {len(segments)}パート)")
+    
+    if dispatch:
+        function_name = FANOUT_WORKER_FUNCTION or context.function_name
+        for segment in segments:
+            lambda_client.invoke(
+                FunctionName=function_name,
+                InvocationType='Event',
+                Payload=json.dumps({
+                    'fanout_action': 'part',
+                    'bucket': bucket,
+                    'job_id': job_id,
+                    'index': segment['index']
+                }).encode('utf-8')
+            )
+        print(f"📨 ワーカー起動: {len(segments)}件 → {function_name}")
+    
+    return manifest
+
+def load_manifest(bucket, job_id):
+    """ジョブのマニフェストを取得"""
+    response = s3.get_object(Bucket=bucket, Key=f"{JOB_PREFIX}{job_id}/manifest.json")
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+def part_key(job_id, index):
+    """パート結果の保存キー"""
+    return f"{JOB_PREFIX}{job_id}/parts/part_{index:04d}.json"
+
+def joined_key(job_id):
+    """結合担当を決めるマーカーのキー"""
+    return f"{JOB_PREFIX}{job_id}/joined"
+
+def failure_key(job_id, index, failed_at):
+    """パート失敗の記録キー（非同期呼び出しの再試行ごとに別キー）"""
+    return f"{JOB_PREFIX}{job_id}/failures/part_{index:04d}_{failed_at}.json"
+
+def claim_join(bucket, job_id, claimed_by):
+    """結合マーカーを条件付きで作成し、結合の担当を1つに決める
+    
+    Returns:
+        作成できた（このInvocationが結合する）ならTrue
+    """
+    try:
+        s3.put_object(
+            Bucket=bucket,
+            Key=joined_key(job_id),
+            Body=json.dumps({
+                'claimed_by': claimed_by,
+                'claimed_at': datetime.now().isoformat()
+            }).encode('utf-8'),
+            ContentType='application/json',
+            IfNoneMatch='*'
+        )
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409'):
+            raise
+        print(f"ℹ️ 分割ジョブの結合は他のInvocationが担当済み: {job_id}")
+        return False
+
+def join_claimed_parts(bucket, job_id):
+    """結合マーカーを取得した後に結合（失敗時はマーカーを消して再実行できるようにする）"""
+    try:
+        return join_parts(bucket, job_id)
+    except Exception:
+        s3.delete_object(Bucket=bucket, Key=joined_key(job_id))
+        raise
+
+def handle_part_failure(bucket, job_id, index, error):
+    """パートの失敗を記録し、試行回数を使い切った場合はジョブを失敗として記録"""
+    record_part_failure(bucket, job_id, index, error)
+    try:
+        failures = [f for f in list_part_failures(bucket, job_id) if f['index'] == index]
+        if len(failures) >= FANOUT_PART_MAX_ATTEMPTS:
+            mark_job_failed(bucket, job_id, index, error, failures)
+    except Exception as e:
+        print(f"⚠️ 分割ジョブの失敗記録に失敗: {e}")
+
+def mark_job_failed(bucket, job_id, index, error, failures):
+    """再試行を使い切ったジョブを status: failed として metadata/ に記録"""
+    manifest = load_manifest(bucket, job_id)
+    video_info = manifest['video_info']
+    metadata = {
+        "video_info": video_info,
+        "processing_info": {
+            "processed_at": datetime.now().isoformat(),
+            "status": "failed",
+            "lambda_function": "extract_transcript",
+            "error": str(error),
+            "fanout": {
+                "job_id": job_id,
+                "parts": len(manifest['segments']),
+                "failed_part": index,
+                "attempts": len(failures),
+                "part_failures": failures
+            }
+        }
+    }
+    
+    metadata_key = f"metadata/extract_{video_info['id']}_{manifest['timestamp']}.json"
+    s3.put_object(
+        Bucket=bucket,
+        Key=metadata_key,
+        Body=json.dumps(metadata, ensure_ascii=False, indent=2).encode('utf-8'),
+        ContentType='application/json'
+    )
+    print(f"❌ 分割ジョブ失敗: {job_id} パート#{index}が{len(failures)}回失敗 → {metadata_key}")
+
+def record_part_failure(bucket, job_id, index, error):
+    """パートの失敗をジョブのメタデータとして jobs/<job_id>/failures/ に記録
+    
+    再試行で成功した後も残し、結合時のメタデータに失敗履歴として含める。
+    """
+    failed_at = datetime.now()
+    try:
+        s3.put_object(
+            Bucket=bucket,
+            Key=failure_key(job_id, index, failed_at.strftime('%Y%m%d_%H%M%S_%f')),
+            Body=json.dumps({
+                'index': index,
+                'error': str(error),
+                'failed_at': failed_at.isoformat()
+            }, ensure_ascii=False).encode('utf-8'),
+            ContentType='application/json'
+        )
+        print(f"📝 パート失敗を記録: #{index}")
+    except Exception as e:
+        print(f"⚠️ パート失敗の記録に失敗: {e}")
+
+def list_part_failures(bucket, job_id):
+    """記録済みのパート失敗を取得"""
+    paginator = s3.get_paginator('list_objects_v2')
+    failures = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{JOB_PREFIX}{job_id}/failures/"):
+        for obj in page.get('Contents', []):
+            response = s3.get_object(Bucket=bucket, Key=obj['Key'])
+            failures.append(json.loads(response['Body'].read().decode('utf-8')))
+    return failures
+
+def part_exists(bucket, job_id, index):
+    """パート結果が保存済みか確認"""
+    try:
+        s3.head_object(Bucket=bucket, Key=part_key(job_id, index))
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+def count_finished_parts(bucket, job_id):
+    """保存済みのパート数を数える"""
+    paginator = s3.get_paginator('list_objects_v2')
+    count = 0
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{JOB_PREFIX}{job_id}/parts/"):
+        count += len(page.get('Contents', []))
+    return count
+
+def process_part(bucket, job_id, index):
+    """1つの時間範囲だけをRange読み込みで抽出し、文字起こし結果を保存"""
+    manifest = load_manifest(bucket, job_id)
+    segment = manifest['segments'][index]
+    print(f"🎵 パート処理中: {job_id} #{index} ({segment['start']:.0f}秒〜, {segment['duration']:.0f}秒)")
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        output_file = os.path.join(temp_dir, f"part_{index:04d}.mp3")
+        # -ss を -i の前に置き、FFmpegに必要な範囲だけをHTTP Rangeで読ませる
+        cmd = [
+            FFMPEG_PATH,
+            '-ss', str(segment['start']),
+            '-t', str(segment['duration']),
+            '-i', presigned_source_url(bucket, manifest['video_key']),
+            '-vn',
+            '-acodec', 'mp3', '-ab', '128k', '-ar', '44100',
+            '-y', output_file
+        ]
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=600)
+        if result.returncode != 0:
+            raise Exception(f"パート音声抽出に失敗しました: {result.stderr[-500:]}")
+        
+        transcript_text = transcribe_audio_text(output_file, select_backend(segment['duration']))
+        if transcript_text is None:
+            raise Exception("パート文字起こしに失敗しました")
+    
+    s3.put_object(
+        Bucket=bucket,
+        Key=part_key(job_id, index),
+        Body=json.dumps({
+            'index': index,
+            'start': segment['start'],
+            'duration': segment['duration'],
+            'text': transcript_text
+        }, ensure_ascii=False).encode('utf-8'),
+        ContentType='application/json'
+    )
+    
+    parts_done = count_finished_parts(bucket, job_id)
+    print(f"✅ パート完了: #{index} ({parts_done}/{len(manifest['segments'])})")
+    return {'job_id': job_id, 'index': index, 'parts_done': parts_done, 'parts_total': len(manifest['segments'])}
+
+def join_parts(bucket, job_id):
+    """全パートの文字起こしを時刻順に結合し、通常処理と同じ形式で保存"""
+    manifest = load_manifest(bucket, job_id)
+    # 未完了のパートがあれば、個々の NoSuchKey ではなく欠けているパートを示して失敗させる
+    missing = [seg['index'] for seg in manifest['segments'] if not part_exists(bucket, job_id, seg['index'])]
+    if missing:
+        raise Exception(f"未完了のパートがあるため結合できません: {job_id} {missing}")
+    
+    texts = []
+    for segment in manifest['segments']:
+        response = s3.get_object(Bucket=bucket, Key=part_key(job_id, segment['index']))
+        texts.append(json.loads(response['Body'].read().decode('utf-8'))['text'])
+    
+    video_info = manifest['video_info']
+    transcript_content = format_transcript_content(video_info, '\n'.join(texts))
+    failures = list_part_failures(bucket, job_id)
+    
+    transcript_key, metadata_key = save_transcript_outputs(
+        bucket, video_info, transcript_content, manifest['timestamp'],
+        {
+            "fanout": {
+                "job_id": job_id,
+                "parts": len(manifest['segments']),
+                "segment_seconds": FANOUT_SEGMENT_SECONDS,
+                "part_failures": failures
+            },
+            "file_sizes": {
+                "transcript_length": len(transcript_content)
+            }
+        }
+    )
+    
+    print(f"✅ 分割ジョブ結合完了: {job_id} → {transcript_key}")
+    return {
+        'message': '音声抽出・文字起こし完了',
+        'video_id': video_info['id'],
+        'transcript_key': transcript_key,
+        'metadata_key': metadata_key
+    }
+
+def run_local_fanout(bucket, video_key, youtube_url='', video_id='unknown', max_workers=None):
+    """Lambda起動の代わりにプロセスプールで同じ分割フローを実行（ローカル試験用）"""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    manifest = start_fanout_job(bucket, video_key, youtube_url, video_id, timestamp, None, dispatch=False)
+    if not manifest:
+        raise Exception("分割ジョブを作成できませんでした")
+    
+    job_id = manifest['job_id']
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(process_part, bucket, job_id, seg['index']) for seg in manifest['segments']]
+        for index, future in enumerate(futures):
+            try:
+                future.result()
+            except Exception as e:
+                record_part_failure(bucket, job_id, index, e)
+                mark_job_failed(bucket, job_id, index, e, [f for f in list_part_failures(bucket, job_id) if f['index'] == index])
+                raise
+    
+    if not claim_join(bucket, job_id, 'local'):
+        raise Exception(f"分割ジョブは既に結合済みまたは結合中です: {job_id}")
+    return join_claimed_parts(bucket, job_id)
@@ -0,0 +1,109 @@
+import os
+import re
+import time
+
+# 記事生成前の文字起こし正規化（フィラー・繰り返しの除去）
+NORMALIZATION_ENABLED = os.environ.get('TRANSCRIPT_NORMALIZATION', 'true').lower() in ('1', 'true', 'yes')
+
+# どこに現れてもフィラーとみなすもの（長音・促音を伴う形）
+STRONG_FILLER_PATTERN = re.compile(r'(?:え(?:ー+っ?|っ)と|ええと|うー+ん|あのー+|そのー+|まあー+)[、，,\s]*')
+# 単独では語の一部になりうるため、前が仮名でない場合のみ除去
+# 「あーいう」「あーゆう」「あーして」の「あー」は指示語（ああいう等）のため残す
+BARE_FILLER_PATTERN = re.compile(r'(?<![ぁ-ゖ])(?:えー+|あー+(?!ー|いう|ゆう|して)|んー+)[、，,\s]*')
+# 読点が続く場合のみフィラーとみなすもの（「あの人」「まあまあ」などは残す）
+COMMA_FILLER_PATTERN = re.compile(r'(?<![ぁ-ゖ])(?:あの|その|まあ|まぁ|なんか|ええ)[、，,]\s*')
+
+# 繰り返しの単位にしない文字（数字・ASCII・数値の区切り）。金額・用量・電話番号・URLは変えない
+_LITERAL_CHARS = r'\x00-\x7f\d０-９Ａ-Ｚａ-ｚ．，－―−‐・／：％'
+# 繰り返しの前後が数字・ASCIIに接していないこと（語や句読点の境界で止まる繰り返しのみ対象）
+_LITERAL_BOUNDARY_BEFORE = r'(?<![\x21-\x7e\d０-９])'
+_LITERAL_BOUNDARY_AFTER = r'(?![\x21-\x7e\d０-９])'
+
+# Whisperのループ: 1〜3文字の単位が5回以上続く（「ははははは」など）
+SHORT_LOOP_PATTERN = re.compile(
+    _LITERAL_BOUNDARY_BEFORE + rf'([^{_LITERAL_CHARS}\s]{{1,3}}?)\1{{4,}}' + _LITERAL_BOUNDARY_AFTER
+)
+# 4〜40文字の語句の直後の繰り返し（「そうですね、そうですね」など）
+# 語句の長さに上限があるため、各位置での照合は定数時間で全体は線形に収まる
+PHRASE_REPEAT_PATTERN = re.compile(
+    _LITERAL_BOUNDARY_BEFORE + rf'([^{_LITERAL_CHARS}\s]{{4,40}}?)(?:[、，,\s]*\1)+' + _LITERAL_BOUNDARY_AFTER
+)
+
+# 文の区切り（句点・疑問符・感嘆符・改行）
+SENTENCE_PATTERN = re.compile(r'[^。！？!?\n]*(?:[。！？!?]+|\n|$)')
+
+# 除去後に残る句読点・空白の整理
+COMMA_RUN_PATTERN = re.compile(r'[、，,](?:\s*[、，,])+')
+COMMA_BEFORE_PERIOD_PATTERN = re.compile(r'[、，,]\s*(?=[。！？!?])')
+LEADING_COMMA_PATTERN = re.compile(r'(^|[。！？!?\n])\s*[、，,]\s*')
+SPACE_RUN_PATTERN = re.compile(r'[ \t　]+')
+
+def count_tokens(text):
+    """記事生成モデルのトークン数（tiktoken未導入時は文字数からの概算）
+    
+    Returns:
+        (トークン数, 計測方法)
+    """
+    try:
+        import tiktoken
+        return len(tiktoken.get_encoding('cl100k_base').encode(text)), 'tiktoken'
+    except Exception:
+        # cl100k_base では日本語はおおむね1文字1トークン、ASCIIは約4文字1トークン
+        ascii_chars = sum(1 for ch in text if ch.isascii())
+        return (len(text) - ascii_chars) + (ascii_chars + 3) // 4, 'estimate'
+
+def dedupe_sentences(text):
+    """直前と同じ文の連続（Whisperの幻覚ループ）を1つにまとめる"""
+    kept = []
+    previous = None
+    removed = 0
+    for match in SENTENCE_PATTERN.finditer(text):
+        sentence = match.group(0)
+        key = sentence.strip()
+        if key and key == previous:
+            removed += 1
+            continue
+        if key:
+            previous = key
+        kept.append(sentence)
+    return ''.join(kept), removed
+
+def normalize_transcript(transcript_text):
+    """フィラー・繰り返し・Whisperのループを除去してプロンプトを短縮
+    
+    すべて事前コンパイル済みの正規表現による数パスの置換で、長時間の文字起こしでも線形時間。
+    
+    Returns:
+        (正規化後のテキスト, 除去件数・トークン削減量などの統計情報)
+    """
+    started = time.monotonic()
+    text = transcript_text
+    
+    text, strong = STRONG_FILLER_PATTERN.subn('', text)
+    text, bare = BARE_FILLER_PATTERN.subn('', text)
+    text, comma = COMMA_FILLER_PATTERN.subn('', text)
+    text, loops = SHORT_LOOP_PATTERN.subn(r'\1', text)
+    text, repeats = PHRASE_REPEAT_PATTERN.subn(r'\1', text)
+    text, sentences = dedupe_sentences(text)
+    
+    text = COMMA_RUN_PATTERN.sub('、', text)
+    text = COMMA_BEFORE_PERIOD_PATTERN.sub('', text)
+    text = LEADING_COMMA_PATTERN.sub(r'\1', text)
+    text = SPACE_RUN_PATTERN.sub(' ', text).strip()
+    
+    tokens_before, counter = count_tokens(transcript_text)
+    tokens_after, _ = count_tokens(text)
+    stats = {
+        "chars_before": len(transcript_text),
+        "chars_after": len(text),
+        "tokens_before": tokens_before,
+        "tokens_after": tokens_after,
+        "token_reduction": tokens_before - tokens_after,
+        "token_reduction_ratio": round((tokens_before - tokens_after) / tokens_before, 4) if tokens_before else 0.0,
+        "token_counter": counter,
+        "fillers_removed": strong + bare + comma,
+        "loops_collapsed": loops + sentences,
+        "repeats_collapsed": repeats,
+        "elapsed_ms": round((time.monotonic() - started) * 1000, 1)
+    }
+    return text, stats
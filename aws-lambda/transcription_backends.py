@@ -0,0 +1,187 @@
+import boto3
+import os
+import time
+import openai
+from abc import ABC, abstractmethod
+
+# バックエンド選択（openai / local / auto）
+TRANSCRIPTION_BACKEND = os.environ.get('TRANSCRIPTION_BACKEND', 'openai').lower()
+
+# auto選択の閾値: 短い音声はアップロードを省けるローカルが速い。
+# キューが詰まっている時はレート制限を避けるため長めの音声もローカルに回す。
+LOCAL_SHORT_SECONDS = int(os.environ.get('LOCAL_SHORT_SECONDS', '180'))
+LOCAL_MAX_SECONDS = int(os.environ.get('LOCAL_MAX_SECONDS', '1200'))
+QUEUE_DEPTH_THRESHOLD = int(os.environ.get('QUEUE_DEPTH_THRESHOLD', '5'))
+# キューの深さを参照するSQS（任意）
+TRANSCRIPTION_QUEUE_URL = os.environ.get('TRANSCRIPTION_QUEUE_URL', '')
+
+# ローカルエンジン（faster-whisper, CTranslate2 int8）
+# Containerイメージではビルド時に /opt/whisper-models へモデルを同梱し、環境変数で指す（Dockerfile参照）
+LOCAL_WHISPER_MODEL = os.environ.get('LOCAL_WHISPER_MODEL', 'small')
+LOCAL_WHISPER_MODEL_DIR = os.environ.get('LOCAL_WHISPER_MODEL_DIR', '/tmp/whisper-models')
+
+# コスト見積もり（USD）
+OPENAI_WHISPER_USD_PER_MINUTE = 0.006
+LAMBDA_USD_PER_GB_SECOND = 0.0000166667
+LAMBDA_MEMORY_GB = int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', '2048')) / 1024
+
+class TranscriptionBackend(ABC):
+    """文字起こしバックエンドの共通インターフェース
+    
+    transcribe() はどのバックエンドでも同じ形式の結果を返す:
+    {'text': str, 'segments': [{'start': 秒, 'end': 秒, 'text': str}], 'language': str, 'backend': 名前}
+    """
+    
+    name = 'base'
+    # キャッシュキーなどに使うモデル識別子
+    model = None
+    
+    @abstractmethod
+    def transcribe(self, audio_file_path, language='ja'):
+        """音声ファイルを文字起こし"""
+    
+    @abstractmethod
+    def estimate_cost(self, audio_seconds, elapsed_seconds):
+        """1回の文字起こしにかかるコストの見積もり（USD）"""
+
+class OpenAIWhisperBackend(TranscriptionBackend):
+    """OpenAI Whisper API（whisper-1）"""
+    
+    name = 'openai'
+    model = 'whisper-1'
+    
+    def transcribe(self, audio_file_path, language='ja'):
+        # OpenAI 0.28.0 安定版での初期化
+        openai.api_key = os.environ['OPENAI_API_KEY']
+        
+        with open(audio_file_path, 'rb') as audio_file:
+            # OpenAI 0.28.0 旧API形式（安定版）
+            transcript = openai.Audio.transcribe(
+                model=self.model,
+                file=audio_file,
+                language=language,
+                response_format="verbose_json"
+            )
+        
+        return {
+            'text': transcript.get('text', ''),
+            'segments': [
+                {'start': float(seg['start']), 'end': float(seg['end']), 'text': seg['text'].strip()}
+                for seg in transcript.get('segments', [])
+            ],
+            'language': language,
+            'backend': self.name
+        }
+    
+    def estimate_cost(self, audio_seconds, elapsed_seconds):
+        # API料金に加え、待ち時間分のLambda課金も発生する
+        return (audio_seconds / 60 * OPENAI_WHISPER_USD_PER_MINUTE
+                + elapsed_seconds * LAMBDA_MEMORY_GB * LAMBDA_USD_PER_GB_SECOND)
+
+class LocalWhisperBackend(TranscriptionBackend):
+    """faster-whisper によるCPU上のローカル文字起こし（int8量子化）"""
+    
+    name = 'local'
+    model = LOCAL_WHISPER_MODEL
+    
+    # ウォームスタート時はモデルを再ロードしない
+    _model = None
+    
+    @classmethod
+    def is_available(cls):
+        try:
+            import faster_whisper  # noqa: F401
+            return True
+        except ImportError:
+            return False
+    
+    def _load_model(self):
+        if LocalWhisperBackend._model is None:
+            from faster_whisper import WhisperModel
+            print(f"📦 ローカル文字起こしモデルをロード中: {LOCAL_WHISPER_MODEL} (int8)")
+            LocalWhisperBackend._model = WhisperModel(
+                LOCAL_WHISPER_MODEL,
+                device='cpu',
+                compute_type='int8',
+                cpu_threads=os.cpu_count() or 1,
+                download_root=LOCAL_WHISPER_MODEL_DIR
+            )
+        return LocalWhisperBackend._model
+    
+    def transcribe(self, audio_file_path, language='ja'):
+        segments, info = self._load_model().transcribe(audio_file_path, language=language, vad_filter=True)
+        segments = [
+            {'start': float(seg.start), 'end': float(seg.end), 'text': seg.text.strip()}
+            for seg in segments
+        ]
+        return {
+            'text': ''.join(seg['text'] for seg in segments),
+            'segments': segments,
+            'language': info.language,
+            'backend': self.name
+        }
+    
+    def estimate_cost(self, audio_seconds, elapsed_seconds):
+        return elapsed_seconds * LAMBDA_MEMORY_GB * LAMBDA_USD_PER_GB_SECOND
+
+BACKENDS = {
+    OpenAIWhisperBackend.name: OpenAIWhisperBackend,
+    LocalWhisperBackend.name: LocalWhisperBackend,
+}
+
+def get_backend(name):
+    """名前からバックエンドを生成"""
+    if name not in BACKENDS:
+        raise ValueError(f"unknown transcription backend: {name}")
+    return BACKENDS[name]()
+
+def current_queue_depth():
+    """SQSの待ちメッセージ数を取得（未設定・失敗時はNone）"""
+    if not TRANSCRIPTION_QUEUE_URL:
+        return None
+    try:
+        sqs = boto3.client('sqs')
+        response = sqs.get_queue_attributes(
+            QueueUrl=TRANSCRIPTION_QUEUE_URL,
+            AttributeNames=['ApproximateNumberOfMessages']
+        )
+        return int(response['Attributes']['ApproximateNumberOfMessages'])
+    except Exception as e:
+        print(f"⚠️ キューの深さの取得に失敗: {e}")
+        return None
+
+def select_backend(duration, queue_depth=None, requested=None):
+    """ジョブごとにバックエンドを選択
+    
+    requested（イベント指定）> TRANSCRIPTION_BACKEND の順に優先し、
+    auto の場合は音声の長さとキューの深さから決める。
+    """
+    name = (requested or TRANSCRIPTION_BACKEND).lower()
+    
+    if name == 'auto':
+        if queue_depth is None:
+            queue_depth = current_queue_depth()
+        name = 'openai'
+        if LocalWhisperBackend.is_available():
+            if duration <= LOCAL_SHORT_SECONDS:
+                name = 'local'
+            elif queue_depth is not None and queue_depth >= QUEUE_DEPTH_THRESHOLD and duration <= LOCAL_MAX_SECONDS:
+                name = 'local'
+        print(f"🔀 文字起こしバックエンド自動選択: {name} (長さ {duration}秒, キュー {queue_depth})")
+    
+    return get_backend(name)
+
+def benchmark_backend(backend, audio_file_path, audio_seconds, language='ja'):
+    """1ファイルを文字起こしして実時間係数（RTF）とコストを計測"""
+    started = time.monotonic()
+    result = backend.transcribe(audio_file_path, language=language)
+    elapsed = time.monotonic() - started
+    return {
+        'backend': backend.name,
+        'audio_seconds': audio_seconds,
+        'elapsed_seconds': round(elapsed, 3),
+        'real_time_factor': round(elapsed / audio_seconds, 4) if audio_seconds else None,
+        'estimated_cost_usd': round(backend.estimate_cost(audio_seconds, elapsed), 6),
+        'segments': len(result['segments']),
+        'characters': len(result['text'])
+    }
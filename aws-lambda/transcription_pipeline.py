@@ -0,0 +1,193 @@
+import os
+import signal
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from extract_transcript_lambda import FFMPEG_PATH, choose_extraction_mode, probe_media
+
+# エンコードと文字起こしのパイプライン化（再エンコードが必要な長尺音声のみ）
+PIPELINE_ENABLED = os.environ.get('PIPELINE_ENABLED', '').lower() in ('1', 'true', 'yes')
+PIPELINE_MIN_SECONDS = int(os.environ.get('PIPELINE_MIN_SECONDS', '900'))
+# FFmpegが書き出すセグメントの長さ（128kbpsで約4.8MB, Whisperの25MB上限に十分収まる）
+PIPELINE_SEGMENT_SECONDS = int(os.environ.get('PIPELINE_SEGMENT_SECONDS', '300'))
+# 同時に文字起こしするワーカー数
+PIPELINE_WORKERS = int(os.environ.get('PIPELINE_WORKERS', '3'))
+# /tmp に置いておく未処理セグメントの上限。超えたらFFmpegを一時停止する
+PIPELINE_MAX_PENDING = int(os.environ.get('PIPELINE_MAX_PENDING', '4'))
+PIPELINE_POLL_SECONDS = 0.2
+# FFmpegの監視: 全体の上限秒数と、一時停止中以外で新しいセグメントが出ないまま経過してよい秒数
+PIPELINE_TIMEOUT_SECONDS = int(os.environ.get('PIPELINE_TIMEOUT_SECONDS', '840'))
+PIPELINE_STALL_SECONDS = int(os.environ.get('PIPELINE_STALL_SECONDS', '120'))
+
+def should_pipeline(video_path, probe=None):
+    """パイプライン処理の対象か判定（再エンコードが必要で十分に長い入力のみ）
+    
+    Returns:
+        判定に使ったprobe（対象外ならNone）
+    """
+    if not PIPELINE_ENABLED:
+        return None
+    probe = probe or probe_media(video_path)
+    if not probe or not probe['duration'] or probe['duration'] < PIPELINE_MIN_SECONDS:
+        return None
+    file_ext = os.path.splitext(video_path)[1].lower()
+    mode, _ = choose_extraction_mode(file_ext, probe, os.path.getsize(video_path))
+    return probe if mode == 'transcode' else None
+
+def read_segment_list(list_file):
+    """FFmpegのsegment muxerが書き出した完了済みセグメント一覧（CSV）を読む
+    
+    Returns:
+        [(ファイル名, 開始秒, 終了秒), ...] - 書きかけの最終行は含めない
+    """
+    if not os.path.exists(list_file):
+        return []
+    with open(list_file) as f:
+        content = f.read()
+    
+    entries = []
+    for line in content.split('\n')[:-1]:
+        name, start, end = line.rsplit(',', 2)
+        entries.append((name, float(start), float(end)))
+    return entries
+
+def run_transcription_pipeline(video_path, work_dir, backend, on_segment=None):
+    """FFmpegでセグメントを書き出しながら、完了したものから順に文字起こし
+    
+    エンコードと文字起こしを重ねることで全体の所要時間を max(エンコード, 文字起こし) に近づける。
+    未処理セグメントが PIPELINE_MAX_PENDING に達したらFFmpegを SIGSTOP で止め、
+    /tmp の使用量を一定に保つ（文字起こし済みのセグメントは即座に削除）。
+    FFmpegが PIPELINE_TIMEOUT_SECONDS 以内に終わらない場合、または一時停止中以外で
+    PIPELINE_STALL_SECONDS の間セグメントが増えない場合は停止して例外を送出する。
+    
+    Args:
+        on_segment: セグメントの文字起こし後、削除前に呼ばれる (index, path)（S3への保存など）
+    
+    Returns:
+        (audio_data, 文字起こしテキスト)
+    """
+    segment_dir = os.path.join(work_dir, 'segments')
+    os.makedirs(segment_dir, exist_ok=True)
+    list_file = os.path.join(segment_dir, 'segments.csv')
+    log_file = os.path.join(segment_dir, 'ffmpeg.log')
+    
+    cmd = [
+        FFMPEG_PATH, '-v', 'error', '-i', video_path,
+        '-vn', '-acodec', 'mp3', '-ab', '128k', '-ar', '44100',
+        '-f', 'segment',
+        '-segment_time', str(PIPELINE_SEGMENT_SECONDS),
+        '-reset_timestamps', '1',
+        '-segment_list', list_file,
+        '-segment_list_type', 'csv',
+        '-y', os.path.join(segment_dir, 'seg_%04d.mp3')
+    ]
+    
+    print(f"🔀 パイプライン処理開始: {PIPELINE_SEGMENT_SECONDS}秒ごとのセグメント, ワーカー{PIPELINE_WORKERS}")
+    started = time.monotonic()
+    stats = {'segments': 0, 'bytes': 0, 'paused_count': 0, 'encode_sec': None}
+    
+    def transcribe_segment(index, path, start):
+        stats['bytes'] += os.path.getsize(path)
+        result = backend.transcribe(path, language='ja')
+        if on_segment:
+            on_segment(index, path)
+        os.remove(path)
+        print(f"✅ セグメント{index}の文字起こし完了 ({len(result['text'])}文字)")
+        # 全体の時刻に揃えたセグメントも返す
+        segments = [dict(seg, start=seg['start'] + start, end=seg['end'] + start) for seg in result['segments']]
+        return result['text'], segments
+    
+    with open(log_file, 'w') as log:
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=log)
+    
+    futures = []
+    paused = False
+    last_end = 0.0
+    last_progress = time.monotonic()
+    
+    try:
+        with ThreadPoolExecutor(max_workers=PIPELINE_WORKERS) as pool:
+            while True:
+                finished = proc.poll() is not None
+                if finished and stats['encode_sec'] is None:
+                    stats['encode_sec'] = round(time.monotonic() - started, 3)
+                
+                # 新しく完了したセグメントをワーカーに渡す
+                entries = read_segment_list(list_file)
+                for name, start, end in entries[len(futures):]:
+                    path = os.path.join(segment_dir, name)
+                    futures.append(pool.submit(transcribe_segment, len(futures), path, start))
+                    last_end = end
+                    last_progress = time.monotonic()
+                
+                if finished:
+                    break
+                
+                # ウォッチドッグ: FFmpegが固まった場合にLambdaのタイムアウトまで待ち続けない
+                now = time.monotonic()
+                if paused:
+                    last_progress = now
+                error = None
+                if now - started > PIPELINE_TIMEOUT_SECONDS:
+                    error = f"FFmpegセグメント出力が{PIPELINE_TIMEOUT_SECONDS}秒以内に終わりませんでした"
+                elif now - last_progress > PIPELINE_STALL_SECONDS:
+                    error = f"FFmpegセグメント出力が{PIPELINE_STALL_SECONDS}秒間進みませんでした"
+                if error:
+                    # 未着手のセグメントは取り消し、FFmpegは即座に止める（残りはfinallyで回収）
+                    for future in futures:
+                        future.cancel()
+                    if paused:
+                        os.kill(proc.pid, signal.SIGCONT)
+                        paused = False
+                    proc.kill()
+                    raise Exception(error)
+                
+                # バックプレッシャー: 未処理が溜まったらFFmpegを止め、捌けたら再開
+                outstanding = sum(not f.done() for f in futures)
+                if not paused and outstanding >= PIPELINE_MAX_PENDING:
+                    os.kill(proc.pid, signal.SIGSTOP)
+                    paused = True
+                    stats['paused_count'] += 1
+                elif paused and outstanding < PIPELINE_MAX_PENDING:
+                    os.kill(proc.pid, signal.SIGCONT)
+                    paused = False
+                
+                time.sleep(PIPELINE_POLL_SECONDS)
+            
+            if proc.returncode != 0:
+                with open(log_file) as log:
+                    raise Exception(f"FFmpegセグメント出力に失敗しました: {log.read()[-500:]}")
+            
+            results = [f.result() for f in futures]
+    
+    finally:
+        if proc.poll() is None:
+            if paused:
+                os.kill(proc.pid, signal.SIGCONT)
+            proc.kill()
+            proc.wait()
+    
+    stats['segments'] = len(results)
+    total_sec = round(time.monotonic() - started, 3)
+    print(f"✅ パイプライン完了: {len(results)}セグメント, エンコード{stats['encode_sec']}秒 / 全体{total_sec}秒")
+    
+    audio_data = {
+        'file_path': None,
+        'duration': int(last_end),
+        'file_size_mb': stats['bytes'] / (1024 * 1024),
+        'extension': '.mp3',
+        'audio_codec': None,
+        'extraction_mode': 'pipeline',
+        'extraction_workers': 1,
+        'pipeline': {
+            'segments': stats['segments'],
+            'segment_seconds': PIPELINE_SEGMENT_SECONDS,
+            'workers': PIPELINE_WORKERS,
+            'encode_sec': stats['encode_sec'],
+            'total_sec': total_sec,
+            'ffmpeg_paused': stats['paused_count']
+        },
+        'transcript_segments': [seg for _, segments in results for seg in segments]
+    }
+    return audio_data, ''.join(text for text, _ in results)
@@ -7,10 +7,13 @@ import base64
 from datetime import datetime
 from bs4 import BeautifulSoup
 from urllib.parse import unquote
+from invocation_profiler import profile_handler
+from request_hedging import HEDGING_ENABLED, hedge_stats, hedged_call
 
 # AWS clients
 s3 = boto3.client('s3')
 
+@profile_handler('wordpress_publish')
 def lambda_handler(event, context):
     """
     Lambda関数3: HTML記事をWordPressに自動投稿
@@ -77,6 +80,8 @@ def lambda_handler(event, context):
                 "article_key": article_key
             }
         }
+        if HEDGING_ENABLED:
+            metadata['processing_info']['hedging'] = hedge_stats()
         
         metadata_key = f"metadata/wordpress_{video_id}_{timestamp}.json"
         s3.put_object(
@@ -191,6 +196,7 @@ class WordPressAPIClient:
             if featured_media_id:
                 print(f"   アイキャッチ画像: メディアID {featured_media_id}")
             
+            # 投稿作成は冪等でないためヘッジしない（2本目が成功すると下書きが重複する）
             response = requests.post(
                 f"{self.api_url}/posts",
                 headers=self.headers,
@@ -273,9 +279,13 @@ class WordPressAPIClient:
         try:
             print(f"📥 YouTubeサムネイルをダウンロード中: {thumbnail_url}")
             
-            # サムネイル画像をダウンロード
-            response = requests.get(thumbnail_url, timeout=30)
-            response.raise_for_status()
+            # サムネイル画像をダウンロード（読み取りのみで冪等なためヘッジ対象）
+            def fetch_thumbnail():
+                response = requests.get(thumbnail_url, timeout=30)
+                response.raise_for_status()
+                return response
+            
+            response = hedged_call('wordpress.thumbnail', fetch_thumbnail)
             
             # ファイル名を生成
             safe_title = "".join(c for c in video_title if c.isalnum() or c in (' ', '-', '_')).rstrip()
@@ -294,6 +304,7 @@ class WordPressAPIClient:
             }
             
             print(f"📤 WordPressメディアライブラリにアップロード中...")
+            # メディア作成も冪等でないためヘッジしない
             upload_response = requests.post(
                 f"{self.api_url}/media",
                 headers={'Authorization': self.headers['Authorization']},